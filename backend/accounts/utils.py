@@ -12,6 +12,7 @@ from .models import OneTimeToken
 
 from container.models import Container
 from datasource.models import Datasource, Connection
+from datasource.utils import ColumnTypeInference, peek_batches
 from datalab.models import (
     Datalab,
     Module,
@@ -23,6 +24,7 @@ from datalab.models import (
     Column,
 )
 from datalab.utils import combine_data
+from datalab.storage import store_data
 from workflow.models import Workflow, Filter, Rule, Condition, Formula
 
 from scheduler.utils import send_email
@@ -101,8 +103,14 @@ def seed_data(user):
         datasource = Datasource(
             container=demo_container, name=name, connection=connection
         )
-        datasource.data = datasource.retrieve_data()
-        datasource.fields = [field for field in datasource.data[0]]
+        first_batch, data = peek_batches(datasource.retrieve_data())
+        datasource.fields = [field for field in first_batch[0]]
+        datasource.save()
+
+        inference = ColumnTypeInference()
+        datasource.write_data(inference.observe(data))
+        datasource.types = inference.types()
+        datasource.columnStats = inference.stats()
         datasource.save()
 
         return datasource
@@ -193,7 +201,7 @@ def seed_data(user):
             **{field.name: randint(1, 100) < 90 for field in attendance_form_fields},
             # **{field.name: randint(1, 40) * 0.25 for field in grade_form_fields},
         }
-        for student in students_datasource.data
+        for student in students_datasource.iter_rows()
     ]
 
     demo_modules.append(
@@ -260,8 +268,9 @@ def seed_data(user):
         steps=demo_modules,
         order=demo_order,
     )
-    demo_datalab.data = combine_data(demo_datalab.steps)
+    data = combine_data(demo_datalab.steps, snapshots=demo_datalab.snapshots)
     demo_datalab.save()
+    store_data(demo_datalab, data)
 
     demo_filter = Filter(
         parameters=["class"],
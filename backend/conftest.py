@@ -0,0 +1,8 @@
+import os
+
+import django
+
+# The tests are run with the self-contained test settings
+os.environ.setdefault("ONTASK_TEST", "1")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ontask.settings")
+django.setup()
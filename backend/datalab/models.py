@@ -10,6 +10,8 @@ from mongoengine.fields import (
     EmbeddedDocumentField,
     DateTimeField,
     FloatField,
+    ObjectIdField,
+    DynamicField,
 )
 
 from container.models import Container
@@ -116,5 +118,60 @@ class Datalab(Document):
     name = StringField(required=True)
     steps = EmbeddedDocumentListField(Module)
     data = ListField(DictField())
+    # If the data is stored row by row (as DatalabRows) rather than inline, the
+    # version of the rows that make up the current data
+    rowVersion = ObjectIdField(null=True)
+    # Incremented by every write of the data or of the form data that it is
+    # built from, so that a build can detect whether its inputs have changed
+    revision = IntField(default=0)
+    # The snapshot of each datasource that the data was last built from,
+    # keyed by the id of the datasource
+    snapshots = DictField()
     order = EmbeddedDocumentListField(Column)
     charts = EmbeddedDocumentListField(Chart)
+
+
+class RowKey(EmbeddedDocument):
+    field = StringField(required=True)
+    value = DynamicField()
+
+
+class RowWord(EmbeddedDocument):
+    field = StringField(required=True)
+    word = StringField(required=True)
+
+
+class RowRank(EmbeddedDocument):
+    field = StringField(required=True)
+    ascending = IntField(required=True)
+    descending = IntField(required=True)
+
+
+class DatalabRow(Document):
+    # A single record of the data of a DataLab that is stored row by row
+    # Cascade delete if the DataLab is deleted
+    datalab = ReferenceField(Datalab, required=True, reverse_delete_rule=2)
+    version = ObjectIdField(required=True)  # Rebuilding the data creates a new version
+    index = IntField(required=True)  # Position of the record in the data
+    data = DictField()
+    # Values of the fields by which single records are looked up, i.e. the primary
+    # keys of forms and the permission fields of web forms
+    primaryKeys = EmbeddedDocumentListField(RowKey)
+    permissionKeys = EmbeddedDocumentListField(RowKey)
+    # The words of the displayed (lower-case) text of each field, by the start of
+    # which records are filtered and searched
+    words = EmbeddedDocumentListField(RowWord)
+    # The position of the record in the data when sorted by each field (in either
+    # direction), so that a page of sorted records is a range of positions
+    ranks = EmbeddedDocumentListField(RowRank)
+
+    meta = {
+        "indexes": [
+            ("datalab", "version", "index"),
+            ("datalab", "version", "primaryKeys.field", "primaryKeys.value"),
+            ("datalab", "version", "permissionKeys.field", "permissionKeys.value"),
+            ("datalab", "version", "words.word", "words.field"),
+            ("datalab", "version", "ranks.field", "ranks.ascending"),
+            ("datalab", "version", "ranks.field", "ranks.descending"),
+        ]
+    }
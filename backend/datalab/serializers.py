@@ -1,3 +1,4 @@
+from collections import defaultdict
 from rest_framework import serializers
 from rest_framework_mongoengine.serializers import (
     DocumentSerializer,
@@ -44,20 +45,67 @@ class DatasourceSerializer(DocumentSerializer):
         fields = ["id", "name", "fields"]
 
 
+def reference_id(document, field):
+    """ Id of the document referenced by a field, without dereferencing it """
+
+    value = document._data.get(field)
+    return getattr(value, "id", value)
+
+
+# Only the fields which are output by the nested serializers are loaded, e.g. the
+# data of datasources and the content of sent emails are never loaded
+DATASOURCE_FIELDS = ["id", "container", "name", "fields"]
+ACTION_FIELDS = (
+    ["id", "datalab", "name", "emailSettings.field"]
+    + [f"emailJobs.{field}" for field in EmailJob._fields if field != "emails"]
+    + [f"emailJobs.emails.{field}" for field in Email._fields if field != "content"]
+)
+
+
+class DatalabListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        datalabs = list(data)
+        self.child.retrieve_related(datalabs)
+        return super().to_representation(datalabs)
+
+
 class DatalabSerializer(DocumentSerializer):
     datasources = serializers.SerializerMethodField()
     actions = serializers.SerializerMethodField()
 
+    def retrieve_related(self, datalabs):
+        """ Retrieve the datasources and actions of all of the given DataLabs,
+            using a single query per collection """
+
+        containers = list({reference_id(datalab, "container") for datalab in datalabs})
+        self.related_datasources = defaultdict(list)
+        datasources = Datasource.objects(container__in=containers)
+        for datasource in datasources.only(*DATASOURCE_FIELDS):
+            container = reference_id(datasource, "container")
+            self.related_datasources[container].append(datasource)
+
+        self.related_actions = defaultdict(list)
+        actions = Workflow.objects(datalab__in=[datalab.id for datalab in datalabs])
+        for action in actions.only(*ACTION_FIELDS):
+            self.related_actions[reference_id(action, "datalab")].append(action)
+
+    def to_representation(self, datalab):
+        if not isinstance(self.parent, DatalabListSerializer):
+            self.retrieve_related([datalab])
+        return super().to_representation(datalab)
+
     def get_datasources(self, datalab):
-        datasources = Datasource.objects(container=datalab["container"].id)
+        datasources = self.related_datasources[reference_id(datalab, "container")]
         serializer = DatasourceSerializer(datasources, many=True)
         return serializer.data
 
     def get_actions(self, datalab):
-        actions = Workflow.objects(datalab=datalab.id)
+        actions = self.related_actions[datalab.id]
         serializer = ActionSerializer(actions, many=True)
         return serializer.data
 
     class Meta:
         model = Datalab
-        fields = "__all__"
+        exclude = ["data", "rowVersion", "revision"]
+        read_only_fields = ["snapshots"]
+        list_serializer_class = DatalabListSerializer
@@ -0,0 +1,481 @@
+from bson import ObjectId
+from collections import OrderedDict
+from mongoengine import Q
+from pymongo import UpdateOne
+import re
+
+from .models import Datalab, DatalabRow
+from datasource.dataset import MISSING, cast_number, cast_timestamp
+
+from ontask.settings import DATALAB_ROW_STORAGE, DATASOURCE_BATCH_SIZE
+
+
+def key_fields(steps):
+    """ Fields by which single records of a DataLab are looked up, i.e. the
+        primary keys of its forms and the permission fields of its web forms """
+
+    primary_fields = []
+    permission_fields = []
+    for step in steps:
+        if step.type != "form":
+            continue
+        primary_fields.append(step.form.primary)
+        if step.form.webForm and step.form.webForm.permission:
+            permission_fields.append(step.form.webForm.permission)
+
+    return primary_fields, permission_fields
+
+
+def permission_value(value):
+    # Permission fields are compared against the email of the user
+    return value.strip() if isinstance(value, str) else value
+
+
+def row_keys(record, primary_fields, permission_fields):
+    return {
+        "primaryKeys": [
+            {"field": field, "value": record[field]}
+            for field in primary_fields
+            if field in record
+        ],
+        "permissionKeys": [
+            {"field": field, "value": permission_value(record[field])}
+            for field in permission_fields
+            if field in record
+        ],
+    }
+
+
+def revision_query(datalab, revision):
+    # Revisions only increase, so the revision is unchanged if it is not greater
+    # (which also matches DataLabs stored before revisions were introduced)
+    query = Q(id=datalab.id)
+    if revision is not None:
+        query &= Q(revision__not__gt=revision)
+    return query
+
+
+def field_types(steps):
+    """ Types of the fields of the data of a DataLab, keyed by label """
+
+    types = {}
+    for step in steps:
+        if step.type == "datasource":
+            for field in step.datasource.fields:
+                types[step.datasource.labels[field]] = step.datasource.types.get(field)
+        elif step.type in ["form", "computed"]:
+            for field in step[step.type].fields:
+                types[field.name] = field.type
+
+    return types
+
+
+def display_value(value):
+    """ Lower-case text of a value, as it is displayed in the data table """
+
+    if value is None or value is MISSING:
+        return ""
+    if isinstance(value, list):
+        return ", ".join(display_value(item) for item in value)
+    return str(value).lower()
+
+
+def sort_key(value, field_type):
+    """ Value by which a value of a field is sorted, or None if it is missing.
+        Values of number and date fields (and numbers in any field) are sorted
+        numerically, before all other values (which are sorted by their
+        displayed text). The keys of rows are ordered the same way by MongoDB,
+        in which numbers precede strings. """
+
+    if value is None or value is MISSING:
+        return None
+
+    number = None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        number = float(value)
+    elif field_type == "number":
+        number = cast_number(value)
+    elif field_type == "date":
+        number = cast_timestamp(value)
+
+    # NaN isn't ordered, hence it is sorted by its text
+    if number is not None and number == number:
+        return number
+    return display_value(value)
+
+
+def search_words(text):
+    """ Words of a text, by the start of which the records of a DataLab are
+        filtered and searched """
+
+    return re.findall(r"\w+", text.lower())
+
+
+def words_match(words, value_words):
+    # Each of the words starts one of the words of the value
+    return all(any(value.startswith(word) for value in value_words) for word in words)
+
+
+def sorted_indices(keys, descending=False):
+    """ Indices of a list of sort keys in sorted order, with the missing (None)
+        keys last. Equal keys are kept in their order, in either direction. """
+
+    present = [index for (index, key) in enumerate(keys) if key is not None]
+    absent = [index for (index, key) in enumerate(keys) if key is None]
+
+    # Numeric keys precede text keys
+    present.sort(
+        key=lambda index: (isinstance(keys[index], str), keys[index]),
+        reverse=descending,
+    )
+    return present + absent
+
+
+def sort_ranks(keys):
+    # Tuple of the (ascending, descending) position of each key in sorted order
+    ranks = [[0, 0] for _ in keys]
+    for (direction, descending) in enumerate([False, True]):
+        for (position, index) in enumerate(sorted_indices(keys, descending)):
+            ranks[index][direction] = position
+    return ranks
+
+
+def row_rank(field, ranks):
+    return {"field": field, "ascending": ranks[0], "descending": ranks[1]}
+
+
+def row_words(record):
+    return [
+        {"field": field, "word": word}
+        for (field, value) in record.items()
+        for word in sorted(set(search_words(display_value(value))))
+    ]
+
+
+def data_ranks(data, types):
+    """ The ranks of each record of the data, by each of its fields """
+
+    fields = OrderedDict((field, None) for record in data for field in record)
+    records_ranks = [[] for _ in data]
+    for field in fields:
+        keys = [sort_key(record.get(field), types.get(field)) for record in data]
+        for (ranks, record_ranks) in zip(sort_ranks(keys), records_ranks):
+            record_ranks.append(row_rank(field, ranks))
+
+    return records_ranks
+
+
+def store_data(datalab, data, revision=None):
+    """ Store the (re)built data of a DataLab, either inline or row by row
+        depending on the DATALAB_ROW_STORAGE setting. Rows are written as a new
+        version, which replaces the current version in a single update, so
+        that readers never see partially written data. If a revision is given,
+        then the data is only stored if the DataLab is still at that revision,
+        i.e. if neither its data nor its form data have been written since the
+        data was built. Returns whether the data was stored. """
+
+    if not DATALAB_ROW_STORAGE:
+        is_stored = Datalab.objects(revision_query(datalab, revision)).update(
+            set__data=data, set__rowVersion=None, inc__revision=1
+        )
+        if not is_stored:
+            return False
+
+        DatalabRow.objects(datalab=datalab.id).delete()
+        datalab.data = data
+        datalab.rowVersion = None
+        datalab.reload("revision")
+        return True
+
+    version = ObjectId()
+    (primary_fields, permission_fields) = key_fields(datalab.steps)
+    ranks = data_ranks(data, field_types(datalab.steps))
+    collection = DatalabRow._get_collection()
+
+    batch = []
+    for (index, record) in enumerate(data):
+        row = {"datalab": datalab.id, "version": version, "index": index}
+        row["data"] = record
+        row.update(row_keys(record, primary_fields, permission_fields))
+        row["words"] = row_words(record)
+        row["ranks"] = ranks[index]
+        batch.append(row)
+        if len(batch) == DATASOURCE_BATCH_SIZE:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+    # Versions are ordered by creation time, so a build which finishes after a
+    # build that was started later doesn't replace the newer data
+    is_latest = Datalab.objects(
+        revision_query(datalab, revision)
+        & (Q(rowVersion=None) | Q(rowVersion__lt=version))
+    ).update(set__data=[], set__rowVersion=version, inc__revision=1)
+
+    if not is_latest:
+        DatalabRow.objects(datalab=datalab.id, version=version).delete()
+        datalab.reload("data", "rowVersion", "revision")
+        return False
+
+    # Remove the previous versions, which can no longer be read
+    DatalabRow.objects(datalab=datalab.id, version__lt=version).delete()
+    datalab.data = []
+    datalab.rowVersion = version
+    datalab.reload("revision")
+    return True
+
+
+def row_query(datalab, **query):
+    return {"datalab": datalab.id, "version": datalab.rowVersion, **query}
+
+
+def iter_data(datalab):
+    """ Yield the records of a DataLab in order. Records which are stored row
+        by row are streamed from a cursor. """
+
+    if not datalab.rowVersion:
+        yield from datalab.data
+        return
+
+    cursor = (
+        DatalabRow._get_collection()
+        .find(row_query(datalab), {"_id": False, "data": True})
+        .sort("index", 1)
+        .batch_size(DATASOURCE_BATCH_SIZE)
+    )
+    for row in cursor:
+        yield row["data"]
+
+
+def load_data(datalab):
+    return list(iter_data(datalab))
+
+
+def count_data(datalab):
+    # Records which are stored inline are counted without loading them
+    if not datalab.rowVersion:
+        result = Datalab.objects(id=datalab.id).aggregate(
+            {"$project": {"count": {"$size": {"$ifNull": ["$data", []]}}}}
+        )
+        return next(result, {"count": 0})["count"]
+
+    return DatalabRow.objects(**row_query(datalab)).count()
+
+
+def data_slice(datalab, start, stop):
+    """ Records of a DataLab from index start up to (but excluding) index stop """
+
+    # Only the slice of records which are stored inline is loaded
+    if not datalab.rowVersion:
+        if stop <= start:
+            return []
+        datalab = Datalab.objects(id=datalab.id).fields(
+            slice__data=[start, stop - start]
+        )
+        return datalab.first().data
+
+    query = row_query(datalab, index={"$gte": start, "$lt": stop})
+    cursor = DatalabRow._get_collection().find(query, {"_id": False, "data": True})
+    return [row["data"] for row in cursor.sort("index", 1)]
+
+
+def rows_are_queryable(datalab):
+    """ Whether the rows of a DataLab can be filtered and sorted by way of their
+        indexes, i.e. whether they were stored along with their words and ranks
+        (which is not the case for rows stored by earlier versions) """
+
+    row = DatalabRow._get_collection().find_one(
+        row_query(datalab, index=0), {"_id": False, "ranks": True}
+    )
+    return row is None or "ranks" in row
+
+
+def word_query(word, field=None):
+    # A range of the (indexed) words, which start with the given word
+    word = {"$regex": f"^{re.escape(word)}"}
+    if field is None:
+        return {"words.word": word}
+    return {"words": {"$elemMatch": {"word": word, "field": field}}}
+
+
+def query_rows(datalab, conditions, search, sort_field, descending, page_bounds):
+    """ Select a page of the records of a DataLab which is stored row by row,
+        which are filtered and sorted by way of the indexes of the rows. The
+        conditions are a list of (field, terms), in which each term is a list of
+        words, and the search is a list of words. A record matches if every
+        word of the search starts a word of one of its fields, and if for each
+        condition every word of one of the terms starts a word of the field.
+        Records are sorted by their rank, i.e. their position in the data when
+        sorted by the field. The page is given by a function of the number of
+        matching records that returns (page, start, stop). Returns (records,
+        total, page). """
+
+    collection = DatalabRow._get_collection()
+    rank = "descending" if descending else "ascending"
+
+    clauses = []
+    for (field, terms) in conditions:
+        matches = [[word_query(word, field) for word in words] for words in terms]
+        clauses.append({"$or": [{"$and": match} for match in matches]})
+    clauses.extend(word_query(word) for word in search)
+    query = row_query(datalab)
+    if clauses:
+        query["$and"] = clauses
+
+    # Records are in their original order if no record has a value for the sort
+    # field (which then has no ranks)
+    if sort_field and not collection.find_one(
+        row_query(datalab, **{"ranks.field": sort_field}), {"_id": True}
+    ):
+        sort_field = None
+
+    total = collection.count_documents(query) if clauses else count_data(datalab)
+    (page, start, stop) = page_bounds(total)
+    if stop <= start:
+        return [], total, page
+
+    # A page of every record sorted by a field is a range of the ranks by it
+    if sort_field and not clauses:
+        ranks = {"field": sort_field, rank: {"$gte": start, "$lt": stop}}
+        projection = {"_id": False, "data": True}
+        projection["ranks"] = {"$elemMatch": {"field": sort_field}}
+        query = row_query(datalab, ranks={"$elemMatch": ranks})
+        rows = sorted(
+            collection.find(query, projection), key=lambda row: row["ranks"][0][rank]
+        )
+        return [row["data"] for row in rows], total, page
+
+    # Otherwise the matching records are ordered by their index (or rank), of
+    # which only those of the page are read
+    projection = {"_id": False, "index": True}
+    if sort_field:
+        projection["ranks"] = {"$elemMatch": {"field": sort_field}}
+    rows = list(collection.find(query, projection))
+    if sort_field:
+        rows.sort(key=lambda row: row["ranks"][0][rank])
+    else:
+        rows.sort(key=lambda row: row["index"])
+
+    indices = [row["index"] for row in rows[start:stop]]
+    cursor = collection.find(
+        row_query(datalab, index={"$in": indices}),
+        {"_id": False, "index": True, "data": True},
+    )
+    records = {row["index"]: row["data"] for row in cursor}
+    return [records[index] for index in indices if index in records], total, page
+
+
+def find_rows(datalab, keys, field, value, limit=0):
+    key = {"$elemMatch": {"field": field, "value": value}}
+    query = row_query(datalab, **{keys: key})
+    cursor = DatalabRow._get_collection().find(
+        query, {"_id": False, "index": True, "data": True}, limit=limit
+    )
+    return [(row["index"], row["data"]) for row in cursor.sort("index", 1)]
+
+
+def find_records(datalab, field, value):
+    """ List of (index, record) of the records of a DataLab in which the field
+        (e.g. the primary key of a form) has the given value """
+
+    if not datalab.rowVersion:
+        return [
+            (index, record)
+            for (index, record) in enumerate(datalab.data)
+            if record.get(field, MISSING) == value
+        ]
+
+    return find_rows(datalab, "primaryKeys", field, value)
+
+
+def match_records(datalab, field, values):
+    """ List of (index, record) of the records of a DataLab in which the field
+        has one of the given values. Unlike find_records, the field needn't be
+        one that records are looked up by, so every record is scanned. """
+
+    values = set(values)
+    if not datalab.rowVersion:
+        return [
+            (index, record)
+            for (index, record) in enumerate(datalab.data)
+            if record.get(field, MISSING) in values
+        ]
+
+    query = row_query(datalab, **{f"data.{field}": {"$in": list(values)}})
+    cursor = DatalabRow._get_collection().find(
+        query, {"_id": False, "index": True, "data": True}
+    )
+    return [(row["index"], row["data"]) for row in cursor.sort("index", 1)]
+
+
+def find_permitted_records(datalab, field, user, limit=0):
+    """ List of (index, record) of the records of a DataLab which the user is
+        permitted to access, by way of a web form's permission field """
+
+    if not datalab.rowVersion:
+        records = [
+            (index, record)
+            for (index, record) in enumerate(datalab.data)
+            if permission_value(record.get(field)) == user
+        ]
+        return records[:limit] if limit else records
+
+    return find_rows(datalab, "permissionKeys", field, user, limit)
+
+
+def update_records(datalab, indices, records, fields, key_field, keys):
+    """ Set the given fields of records that are stored row by row, from the
+        updated records at the given indices. Each record is only updated if it
+        still has its given key (e.g. the primary key of a form), i.e. if the
+        data hasn't been rebuilt since the records were read. Returns False if
+        any record wasn't. """
+
+    (primary_fields, permission_fields) = key_fields(datalab.steps)
+    changes_keys = set(fields).intersection(primary_fields + permission_fields)
+    collection = DatalabRow._get_collection()
+
+    for (index, record, key) in zip(indices, records, keys):
+        update = {f"data.{field}": record[field] for field in fields if field in record}
+        if not update:
+            continue
+        if changes_keys:
+            update.update(row_keys(record, primary_fields, permission_fields))
+        update["words"] = row_words(record)
+
+        query = row_query(datalab, index=index, **{f"data.{key_field}": key})
+        if not collection.update_one(query, {"$set": update}).matched_count:
+            return False
+
+    if indices:
+        rank_rows(datalab, fields)
+
+    return True
+
+
+def rank_rows(datalab, fields):
+    """ Rank the rows of a DataLab by the given fields once their values have
+        been updated. The values of each field are read from every row, but only
+        the rows whose ranks have changed are written. """
+
+    types = field_types(datalab.steps)
+    collection = DatalabRow._get_collection()
+
+    for field in fields:
+        projection = {"_id": False, "index": True, f"data.{field}": True}
+        projection["ranks"] = {"$elemMatch": {"field": field}}
+        rows = list(collection.find(row_query(datalab), projection).sort("index", 1))
+        keys = [sort_key(row["data"].get(field), types.get(field)) for row in rows]
+
+        updates = []
+        for (row, ranks) in zip(rows, sort_ranks(keys)):
+            rank = row_rank(field, ranks)
+            query = row_query(datalab, index=row["index"])
+            if not row.get("ranks"):
+                updates.append(UpdateOne(query, {"$push": {"ranks": rank}}))
+            elif row["ranks"][0] != rank:
+                query["ranks.field"] = field
+                updates.append(UpdateOne(query, {"$set": {"ranks.$": rank}}))
+
+        if updates:
+            collection.bulk_write(updates, ordered=False)
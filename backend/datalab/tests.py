@@ -0,0 +1,112 @@
+from collections import Counter
+from contextlib import ExitStack
+from unittest import mock, SkipTest
+
+from bson import ObjectId
+from django.test import SimpleTestCase
+from mongoengine.connection import get_db, register_connection
+from mongoengine.context_managers import switch_db
+from pymongo.errors import ConnectionFailure
+
+from container.models import Container
+from datasource.models import Datasource
+from workflow.models import Workflow, EmailSettings, EmailJob, Email
+
+from .models import Datalab
+from .serializers import DatalabSerializer
+
+from ontask.settings import NOSQL_DATABASE
+
+TEST_DB_ALIAS = "test"
+TEST_DB_NAME = f"{NOSQL_DATABASE['DB']}_test"
+
+
+class DatalabSerializerQueryTest(SimpleTestCase):
+    """ The datasources and actions of a list of DataLabs are retrieved with a
+        fixed number of queries, regardless of the number of DataLabs """
+
+    @classmethod
+    def setUpClass(cls):
+        # The documents are stored in a separate database for the duration of
+        # the tests, which are skipped if the database can't be reached
+        register_connection(
+            TEST_DB_ALIAS,
+            name=TEST_DB_NAME,
+            host=NOSQL_DATABASE["HOST"],
+            serverSelectionTimeoutMS=2000,
+        )
+        try:
+            get_db(TEST_DB_ALIAS).client.server_info()
+        except ConnectionFailure:
+            raise SkipTest("The database is not available")
+
+        super().setUpClass()
+        cls.switched_documents = ExitStack()
+        for document in [Container, Datasource, Datalab, Workflow]:
+            cls.switched_documents.enter_context(switch_db(document, TEST_DB_ALIAS))
+
+        container = Container(owner="owner@test", code="TEST")
+        container.save()
+
+        for index in range(3):
+            Datasource(container=container, name=f"datasource {index}").save()
+
+        cls.datalab_ids = []
+        for index in range(5):
+            datalab = Datalab(container=container, name=f"datalab {index}")
+            datalab.save()
+            cls.datalab_ids.append(datalab.id)
+
+            for action_index in range(2):
+                email = Email(recipient="recipient@test", content="content")
+                Workflow(
+                    container=container,
+                    datalab=datalab,
+                    name=f"action {action_index}",
+                    emailSettings=EmailSettings(
+                        subject="subject", field="email", replyTo="owner@test"
+                    ),
+                    emailJobs=[
+                        EmailJob(job_id=ObjectId(), type="Manual", emails=[email])
+                    ],
+                ).save()
+
+    @classmethod
+    def tearDownClass(cls):
+        get_db(TEST_DB_ALIAS).client.drop_database(TEST_DB_NAME)
+        cls.switched_documents.close()
+        super().tearDownClass()
+
+    def list_queries(self, datalab_ids):
+        """ Serialize the given DataLabs as a list, returning the number of
+            queries made against each collection along with the output """
+
+        queries = Counter()
+        collection_class = type(Datasource._get_collection())
+        find = collection_class.find
+
+        def counted_find(collection, *args, **kwargs):
+            queries[collection.name] += 1
+            return find(collection, *args, **kwargs)
+
+        with mock.patch.object(collection_class, "find", counted_find):
+            datalabs = Datalab.objects(id__in=datalab_ids).exclude("data")
+            data = DatalabSerializer(datalabs, many=True).data
+
+        return queries, data
+
+    def test_list_queries_are_constant(self):
+        datasources = Datasource._get_collection_name()
+        actions = Workflow._get_collection_name()
+
+        for count in [1, len(self.datalab_ids)]:
+            queries, data = self.list_queries(self.datalab_ids[:count])
+
+            self.assertEqual(len(data), count)
+            self.assertEqual(queries[datasources], 1)
+            self.assertEqual(queries[actions], 1)
+            for datalab in data:
+                self.assertEqual(len(datalab["datasources"]), 3)
+                self.assertEqual(len(datalab["actions"]), 2)
+                email = datalab["actions"][0]["emailJobs"][0]["emails"][0]
+                self.assertNotIn("content", email)
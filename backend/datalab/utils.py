@@ -1,11 +1,39 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
+from mongoengine import EmbeddedDocument
+from multiprocessing import get_context
+import hashlib
+import json
 import numexpr as ne
+import numpy as np
+import threading
 
 from .models import Datalab
-from datasource.models import Datasource
+from .storage import (
+    store_data,
+    load_data,
+    iter_data,
+    count_data,
+    data_slice,
+    find_records,
+    match_records,
+    find_permitted_records,
+    update_records,
+    field_types,
+    display_value,
+    sort_key,
+    search_words,
+    words_match,
+    sorted_indices,
+    rows_are_queryable,
+    query_rows,
+)
+from datasource.models import Datasource, DatasourceRow
+from datasource.dataset import MISSING, Column, Dataset, object_array
 from audit.serializers import AuditSerializer
-from workflow.models import Workflow
+from workflow.models import Workflow, EmailCounter
+
+from ontask.settings import DATALAB_BUILD_CACHE, DATALAB_PARALLEL_BUILD
 
 
 def bind_column_types(steps):
@@ -44,142 +72,292 @@ def bind_column_types(steps):
     return steps
 
 
-def calculate_computed_field(formula, record, build_fields, tracking_feedback_data):
-    calculated_value = 0
+# The operators that can be used in the formula of a computed field
+FORMULA_OPERATORS = ["+", "-", "*", "/"]
 
-    populated_formula = []
 
-    def cast_float(value):
-        try:
-            return float(value)
-        except (ValueError, TypeError):
-            return 0
+def compile_computed_field(formula, build_fields):
+    """ Compile the formula of a computed field into a function which evaluates
+        the field for every record of a dataset at once. The aggregations are
+        resolved to the columns that they reference up front, and the arithmetic
+        of the formula is compiled into a single numexpr expression over whole
+        columns (rather than an expression being built and parsed per record). """
 
-    def tracking_feedback_value(action_id, job_id, data_type, record):
-        email_field = tracking_feedback_data[action_id]["email_field"]
-        data = tracking_feedback_data[action_id]["jobs"][job_id][data_type]
-        return (
-            data[record[email_field]]
-            if email_field in record and record[email_field] in data
-            else 0
-        )
+    nodes = formula["document"]["nodes"]
+    expression = []
+    operands = []
 
-    def iterate_aggregation(columns, is_numerical=True):
-        values = []
-
-        for column in columns:
-            split_column = column.split("_")
-
-            if split_column[0] in ["tracking", "feedback"]:
-                data_type = split_column[0]
-
-                if len(split_column) == 1:
-                    for action in tracking_feedback_data:
-                        for email_job in tracking_feedback_data[action]["jobs"]:
-                            values.append(
-                                tracking_feedback_value(
-                                    action, email_job, data_type, record
-                                )
-                            )
-
-                if len(split_column) == 2:
-                    action_id = split_column[1]
-                    for email_job in tracking_feedback_data[action_id]["jobs"]:
-                        values.append(
-                            tracking_feedback_value(
-                                action_id, email_job, data_type, record
-                            )
-                        )
-
-                if len(split_column) == 3:
-                    action_id = split_column[1]
-                    job_id = split_column[2]
-                    values.append(
-                        tracking_feedback_value(action_id, job_id, data_type, record)
-                    )
-
-            else:
-                if len(split_column) == 1:
-                    step_index = int(split_column[0])
-                    for field in build_fields[step_index]:
-                        value = record[field] if field in record else None
-                        values.append(cast_float(value) if is_numerical else value)
-
-                elif len(split_column) == 2:
-                    step_index, field_index = [int(i) for i in split_column]
-                    field = build_fields[step_index][field_index]
-                    value = record[field] if field in record else None
-                    values.append(cast_float(value) if is_numerical else value)
-
-        return values
-
-    # Populate values on first pass-through
-    for node in formula["document"]["nodes"]:
+    for node in nodes:
         node_type = node["type"]
 
         if node_type == "open-bracket":
-            populated_formula.append("(")
+            expression.append("(")
 
         if node_type == "close-bracket":
-            populated_formula.append(")")
+            expression.append(")")
 
         if node_type == "operator":
-            populated_formula.append(node["data"]["type"])
+            # Any other operator renders the expression (and the field) invalid
+            operator = node["data"]["type"]
+            expression.append(operator if operator in FORMULA_OPERATORS else "?")
 
         if node_type == "field":
-            field = node["data"]["name"]
-            populated_formula.append(cast_float(record[field]))
+            expression.append(f"x{len(operands)}")
+            operands.append(("field", node["data"]["name"]))
 
         if node_type == "aggregation":
             aggregation_type = node["data"]["type"]
-            columns = node["data"]["columns"]
-            aggregation_value = 0
-
-            if aggregation_type == "sum":
-                aggregation_value = sum(iterate_aggregation(columns))
-
-            if aggregation_type == "average":
-                values = iterate_aggregation(columns)
-                aggregation_value = sum(values) / len(values) if len(values) else 0
-
-            if aggregation_type == "last":
-                # If the "last" aggregation is part of a larger formula, then treat
-                # it as numerical, since it must be part of a computation
-                values = iterate_aggregation(columns, is_numerical=False)
-                # If the number of nodes is 2, then the aggregation is standalone
-                # It's 2 and not 1, because Slate.js blockmap always starts with a paragraph block
-                if len(formula["document"]["nodes"]) > 2:
-                    aggregation_value = cast_float(values[-1]) if len(values) else 0
-                else:
-                    return values[-1] if len(values) else None
-
-            if aggregation_type == "list":
-                return iterate_aggregation(columns, is_numerical=False)
-
-            if aggregation_type == "concat":
-                delimiter = node["data"]["delimiter"]
-                aggregation_value = iterate_aggregation(columns, is_numerical=False)
-                # Join values even if they are null, as this would be the expected
-                # functionality if the user is trying to construct a .csv
-                # I.e. the number of delimiters should be constant for all rows
-                # Regardless of whether a given column has a value or not
-                return delimiter.join(
-                    [str(x) if x is not None else "" for x in aggregation_value]
+
+            # If the "last" aggregation is part of a larger formula, then treat
+            # it as numerical, since it must be part of a computation
+            # If the number of nodes is 2, then the aggregation is standalone
+            # It's 2 and not 1, because Slate.js blockmap always starts with a paragraph block
+            is_standalone = aggregation_type == "last" and not len(nodes) > 2
+
+            # Non-numerical aggregations are the value of the field in their own right
+            if aggregation_type in ["list", "concat"] or is_standalone:
+                return compile_aggregation(node["data"], build_fields)
+
+            expression.append(f"x{len(operands)}")
+            operands.append((aggregation_type, node["data"]["columns"]))
+
+    expression = "".join(expression)
+
+    def evaluate(dataset, tracking_feedback_data):
+        variables = {}
+        is_valid = np.ones(len(dataset), dtype=bool)
+
+        for (index, (operand_type, operand)) in enumerate(operands):
+            if operand_type == "field":
+                values = number_values(field_column(dataset, operand))
+            else:
+                columns = aggregation_columns(
+                    operand, build_fields, dataset, tracking_feedback_data
+                )
+                values = aggregate_numbers(
+                    operand_type,
+                    [number_values(column) for column in columns],
+                    len(dataset),
                 )
+            variables[f"x{index}"] = values
+            is_valid &= np.isfinite(values)
 
-            populated_formula.append(aggregation_value)
+        if not operands:
+            return [None] * len(dataset)
 
-    populated_formula = "".join([str(x) for x in populated_formula])
+        try:
+            result = ne.evaluate(expression, local_dict=variables)
+        except (ZeroDivisionError, AttributeError, TypeError, KeyError, SyntaxError):
+            return [None] * len(dataset)
 
-    try:
-        return ne.evaluate(populated_formula).item()
-    except (ZeroDivisionError, AttributeError, TypeError, KeyError, SyntaxError):
-        return None
+        # Records with non-finite inputs (e.g. "nan") or results (e.g. from
+        # division by zero) have no value
+        is_valid &= np.isfinite(result)
+        return [
+            value if valid else None
+            for (value, valid) in zip(result.tolist(), is_valid)
+        ]
+
+    return evaluate
+
+
+def compile_aggregation(aggregation, build_fields):
+    """ Compile a list, concat or standalone "last" aggregation, whose values
+        are those of the columns that it references, rather than numbers """
+
+    aggregation_type = aggregation["type"]
+
+    def evaluate(dataset, tracking_feedback_data):
+        columns = aggregation_columns(
+            aggregation["columns"], build_fields, dataset, tracking_feedback_data
+        )
+        columns = [
+            [None if value is MISSING else value for value in column.values]
+            for column in columns
+        ]
+
+        if aggregation_type == "last":
+            return columns[-1] if columns else [None] * len(dataset)
+
+        if aggregation_type == "list":
+            if not columns:
+                return [[] for _ in range(len(dataset))]
+            return [list(values) for values in zip(*columns)]
+
+        # Join values even if they are null, as this would be the expected
+        # functionality if the user is trying to construct a .csv
+        # I.e. the number of delimiters should be constant for all rows
+        # Regardless of whether a given column has a value or not
+        delimiter = aggregation["delimiter"]
+        if not columns:
+            return [""] * len(dataset)
+        columns = [
+            [str(x) if x is not None else "" for x in column] for column in columns
+        ]
+        return [delimiter.join(values) for values in zip(*columns)]
+
+    return evaluate
+
+
+def aggregation_columns(columns, build_fields, dataset, tracking_feedback_data):
+    """ Resolve the columns referenced by an aggregation, i.e. the fields of a
+        step, a single field of a step, or the tracking/feedback data of the
+        email jobs of an action (or of all actions) """
+
+    resolved = []
+
+    for column in columns:
+        split_column = column.split("_")
+
+        if split_column[0] in ["tracking", "feedback"]:
+            data_type = split_column[0]
+            jobs = []
+
+            if len(split_column) == 1:
+                jobs = [
+                    (action_id, job_id)
+                    for action_id in tracking_feedback_data
+                    for job_id in tracking_feedback_data[action_id]["jobs"]
+                ]
+
+            if len(split_column) == 2:
+                action_id = split_column[1]
+                jobs = [
+                    (action_id, job_id)
+                    for job_id in tracking_feedback_data[action_id]["jobs"]
+                ]
+
+            if len(split_column) == 3:
+                jobs = [(split_column[1], split_column[2])]
+
+            for (action_id, job_id) in jobs:
+                action = tracking_feedback_data[action_id]
+                data = action["jobs"][job_id].get(data_type, {})
+                emails = field_column(dataset, action["email_field"]).values
+                resolved.append(
+                    Column(
+                        [
+                            data.get(email, 0) if email is not MISSING else 0
+                            for email in emails
+                        ]
+                    )
+                )
+
+        else:
+            if len(split_column) == 1:
+                step_index = int(split_column[0])
+                resolved.extend(
+                    field_column(dataset, field) for field in build_fields[step_index]
+                )
+
+            elif len(split_column) == 2:
+                step_index, field_index = [int(i) for i in split_column]
+                field = build_fields[step_index][field_index]
+                resolved.append(field_column(dataset, field))
+
+    return resolved
+
+
+def field_column(dataset, field):
+    if field in dataset:
+        return dataset[field]
+
+    return Column(object_array([MISSING] * len(dataset)))
 
 
-def combine_data(steps, datalab_id=None):
+def number_values(column):
+    """ Cast the values of a column as numbers, where values which can't be cast
+        (or are missing) are treated as 0 """
+
+    return column.numbers[0]
+
+
+def aggregate_numbers(aggregation_type, columns, length):
+    if aggregation_type in ["sum", "average"]:
+        # Columns are added one at a time, in the same order as summing the
+        # values of each record would
+        total = np.zeros(length)
+        for values in columns:
+            total = total + values
+
+        if aggregation_type == "average":
+            return total / len(columns) if len(columns) else np.zeros(length)
+        return total
+
+    if aggregation_type == "last":
+        return columns[-1] if len(columns) else np.zeros(length)
+
+    return np.zeros(length)
+
+
+def combine_data(
+    steps, datalab_id=None, snapshots=None, previous=None, workers=None
+):
+    # If a dict of snapshots is provided, then it is populated with the snapshot
+    # of each datasource that the data is built from
+    if snapshots is None:
+        snapshots = {}
+
+    # If the data previously built from the same steps is provided, then computed
+    # values are reused for the records whose inputs to the formula are unchanged
+    previous = previous or []
+
     # Identify the fields used in the build
     # Consumed by the computed column calculation
+    build_fields = step_build_fields(steps)
+
+    # Gather all tracking and feedback data for associated actions
+    # Consumed by the computed column
+    tracking_feedback_data = {}
+    if datalab_id:
+        tracking_feedback_data = retrieve_tracking_feedback_data(datalab_id)
+
+    # Retrieve the datasources used in the build, whose snapshots identify the
+    # version of their data in the build cache keys
+    datasources = retrieve_datasources(steps)
+    for (datasource_id, datasource) in datasources.items():
+        snapshots[datasource_id] = datasource.snapshot
+
+    # Resume the build from the longest prefix of the steps that has been cached
+    # (the first module is always a datasource, so at least one step is needed)
+    keys = build_cache_keys(steps, datasources, build_fields, tracking_feedback_data)
+    start, dataset = 0, None
+    for index in reversed(range(len(steps))):
+        dataset = get_cached_build(keys[index])
+        if dataset is not None:
+            start = index + 1
+            break
+
+    # Load the data of each datasource used in the remaining steps once (even if
+    # it is used by multiple modules), only including the fields used by those modules
+    datasets = load_datasources(steps[start:], datasources)
+
+    # Large builds from scratch can be partitioned across a pool of processes
+    if workers is None:
+        workers = DATALAB_PARALLEL_BUILD["WORKERS"]
+    if start == 0 and workers > 1:
+        dataset = parallel_build(
+            steps, datasets, build_fields, tracking_feedback_data, workers
+        )
+        if dataset is not None:
+            cache_build(keys[-1], dataset)
+            return dataset.to_rows()
+
+    for index in range(start, len(steps)):
+        dataset = apply_step(
+            dataset,
+            steps[index],
+            datasets,
+            build_fields,
+            tracking_feedback_data,
+            previous,
+        )
+        cache_build(keys[index], dataset)
+
+    return dataset.to_rows()
+
+
+def step_build_fields(steps):
     build_fields = [[] for x in range(len(steps))]
     for i, step in enumerate(steps):
         if step["type"] == "datasource":
@@ -190,145 +368,642 @@ def combine_data(steps, datalab_id=None):
             for field in step["fields"]:
                 build_fields[i].append(field["name"])
 
-    # Gather all tracking and feedback data for associated actions
-    # Consumed by the computed column
+    return build_fields
+
+
+def retrieve_tracking_feedback_data(datalab_id):
+    """ Gather the tracking and feedback counts of each recipient of the email
+        jobs of the DataLab's actions, from the materialised email counters
+        (rather than the email jobs, which hold the content of every email) """
+
     tracking_feedback_data = {}
-    if datalab_id:
-        actions = Workflow.objects(datalab=datalab_id)
+    actions = Workflow.objects(datalab=datalab_id).only(
+        "id", "emailSettings.field", "emailJobs.job_id"
+    )
+    for action in actions:
+        action_id = str(action.id)
+        if not "emailSettings" in action or not len(action["emailJobs"]):
+            continue
+
+        tracking_feedback_data[action_id] = {
+            "email_field": action["emailSettings"]["field"],
+            "jobs": {
+                str(email_job.job_id): {"tracking": {}, "feedback": {}}
+                for email_job in action["emailJobs"]
+            },
+        }
+
+    def add_counter(counter):
+        action_id, job_id = str(counter["action"]), str(counter["job"])
+        if action_id in tracking_feedback_data:
+            job = tracking_feedback_data[action_id]["jobs"].get(job_id)
+            if job is not None:
+                job["tracking"][counter["recipient"]] = counter["tracking"]
+                job["feedback"][counter["recipient"]] = counter["feedback"]
+
+    counted_jobs = set()
+    for counter in EmailCounter.objects(datalab=datalab_id).as_pymongo():
+        counted_jobs.add((str(counter["action"]), str(counter["job"])))
+        add_counter(counter)
+
+    # Jobs which were sent before the counters were introduced have their counters
+    # created from the emails of the job the first time that they are needed
+    uncounted_actions = [
+        action_id
+        for (action_id, action) in tracking_feedback_data.items()
+        if any((action_id, job_id) not in counted_jobs for job_id in action["jobs"])
+    ]
+    if uncounted_actions:
+        actions = Workflow.objects(id__in=uncounted_actions).only(
+            "id",
+            "emailJobs.job_id",
+            "emailJobs.emails.recipient",
+            "emailJobs.emails.track_count",
+            "emailJobs.emails.feedback_datetime",
+        )
         for action in actions:
-            action_id = str(action.id)
-            if not "emailSettings" in action or not len(action["emailJobs"]):
-                continue
-
-            tracking_feedback_data[action_id] = {
-                "email_field": action["emailSettings"]["field"],
-                "jobs": {},
-            }
-            for email_job in action["emailJobs"]:
-                job_id = str(email_job.job_id)
-
-                tracking_feedback_data[action_id]["jobs"][job_id] = {
-                    "tracking": {
-                        email["recipient"]: email["track_count"]
-                        for email in email_job["emails"]
-                    }
-                }
+            for email_job in action.emailJobs:
+                if (str(action.id), str(email_job.job_id)) not in counted_jobs:
+                    counters = EmailCounter.create_for_job(
+                        datalab_id, action.id, email_job
+                    )
+                    for counter in counters:
+                        add_counter(counter)
+
+    return tracking_feedback_data
+
+
+def apply_step(
+    dataset, step, datasets, build_fields, tracking_feedback_data, previous
+):
+    """ Create the dataset which results from applying the given step to the
+        dataset built by the steps before it. The given dataset is not modified,
+        as it may be cached. """
 
     # Initialize the dataset using the first module, which is always a datasource
-    first_module = steps[0]["datasource"]
-    datasource = Datasource.objects.get(id=first_module["id"])
-    fields = first_module["fields"]
-    label_map = first_module["labels"]
-
-    data = []
-    for item in datasource.data:
-        record = {}
-        for field, value in item.items():
-            if field in fields:
-                # Add the field to the record object using the field's label
-                record[label_map[field]] = value
-        data.append(record)
-
-    # For each of the remaining modules, incrementally add to the dataset
-    for step in steps[1:]:
-        # Instantiate an object that will be a map of the data generated thus far,
-        # with the key being the matching field specified for this step. This allows
-        #  us to efficiently lookup based on the primary key and find which record
-        # should be extended, instead of having to iterate over the list to find the
-        # matching record for every record in this datasource
-        data_map = defaultdict(list)
+    if dataset is None:
+        module = step["datasource"]
+        return datasets[module["id"]].select(module["fields"]).rename(module["labels"])
+
+    if step["type"] == "datasource" or (
+        step["type"] == "form" and "data" in step["form"]
+    ):
+        return merge_datasets(dataset, *join_module(dataset, step, datasets))
+
+    if step["type"] == "computed":
+        module = step["computed"]
+
+        dataset = Dataset(dataset.columns.items(), len(dataset))
+
+        # Computed fields can reference those computed before them, hence each
+        # field is added to the dataset before the next is evaluated
+        for field in module["fields"]:
+            evaluate = compile_computed_field(field["formula"], build_fields)
+            memo = computed_field_memo(field, build_fields, previous)
+            values = evaluate_computed_field(
+                evaluate, dataset, tracking_feedback_data, memo
+            )
+            dataset.add_column(field["name"], values, field["type"])
+
+    return dataset
+
+
+def join_module(dataset, step, datasets):
+    """ Join the records of a datasource or form module onto the dataset built
+        by the steps before it, returning the module's records along with the
+        indices of the joined records (see join_indices) """
+
+    if step["type"] == "datasource":
+        module = step["datasource"]
+        source = merge_duplicate_records(datasets[module["id"]], module["primary"])
+
+        # The user would have been prompted on how to deal with discrepencies
+        # after they chose the matching field for this module in the model
+        # interface of the DataLab. If the primary discrepency setting is set to
+        # True, then the user wants to keep the records of this datasource even
+        # with values missing for the previous modules. If the matching
+        # discrepency setting is set to True, then the user wants to keep any
+        # records whose matching keys do not exist in this datasource.
+        left_indices, right_indices = join_indices(
+            column_values(dataset, module["matching"]),
+            source[module["primary"]].values,
+            keep_left=discrepency_setting(module, "matching"),
+            keep_right=discrepency_setting(module, "primary"),
+        )
+        return (
+            source.select(module["fields"]).rename(module["labels"]),
+            left_indices,
+            right_indices,
+        )
+
+    module = step["form"]
+
+    # Update the records with this form's data, keeping the records that
+    # don't have any form data
+    form_data = merge_duplicate_records(
+        Dataset.from_rows(module["data"]), module["primary"]
+    )
+    left_indices, right_indices = join_indices(
+        column_values(dataset, module["primary"]),
+        column_values(form_data, module["primary"]),
+        keep_left=True,
+        keep_right=False,
+    )
+    return form_data, left_indices, right_indices
+
+
+def evaluate_computed_field(evaluate, dataset, tracking_feedback_data, memo=None):
+    """ Evaluate a compiled computed field for the records of a dataset. If a memo
+        of previously computed values is given, then only the records whose
+        inputs aren't in the memo are evaluated. """
+
+    if memo is None:
+        return evaluate(dataset, tracking_feedback_data)
+
+    (inputs, results) = memo
+    columns = [column_values(dataset, name) for name in inputs]
+    signatures = zip(*columns) if columns else [()] * len(dataset)
+
+    values = []
+    pending = []
+    for (index, signature) in enumerate(signatures):
+        try:
+            value = results.get(signature, MISSING)
+        except TypeError:
+            value = MISSING
+        if value is MISSING:
+            pending.append(index)
+        values.append(value)
+
+    if pending:
+        evaluated = evaluate(dataset.take(pending), tracking_feedback_data)
+        for (index, value) in zip(pending, evaluated):
+            values[index] = value
+
+    return values
+
+
+def computed_field_inputs(formula, build_fields):
+    """ Identify the fields that a computed field's formula depends on, or None
+        if it also depends on the tracking and feedback data of actions """
+
+    inputs = []
+    try:
+        for node in formula["document"]["nodes"]:
+            if node["type"] == "field":
+                inputs.append(node["data"]["name"])
+
+            if node["type"] == "aggregation":
+                for column in node["data"]["columns"]:
+                    split_column = column.split("_")
+
+                    if split_column[0] in ["tracking", "feedback"]:
+                        return None
+
+                    if len(split_column) == 1:
+                        inputs.extend(build_fields[int(split_column[0])])
+
+                    elif len(split_column) == 2:
+                        step_index, field_index = [int(i) for i in split_column]
+                        inputs.append(build_fields[step_index][field_index])
+
+    except (KeyError, IndexError, ValueError):
+        return None
+
+    return inputs
+
+
+def computed_field_memo(field, build_fields, previous):
+    """ Map the inputs of a computed field to its value, for each of the records
+        of the previously built data """
+
+    if not previous:
+        return None
+
+    inputs = computed_field_inputs(field["formula"], build_fields)
+    if inputs is None:
+        return None
+
+    results = {}
+    for record in previous:
+        if field["name"] in record:
+            signature = tuple(record.get(name, MISSING) for name in inputs)
+            try:
+                results[signature] = record[field["name"]]
+            except TypeError:
+                # Records with unhashable inputs (e.g. lists) are recomputed
+                pass
+
+    return inputs, results
+
+
+def rebuild_datalab_data(datalab, attempts=5):
+    """ Rebuild the data of a DataLab after one or more of its datasources have
+        changed, reusing the computed values of records whose inputs are
+        unchanged. Returns False if none of the datasources have changed since
+        the data was last built. If the data or form data of the DataLab are
+        written while it is being rebuilt (e.g. a form value is entered), then
+        the rebuilt data is discarded and the DataLab is rebuilt again. """
+
+    for attempt in range(attempts):
+        if attempt:
+            datalab.reload()
+
+        # The revision of the form data that the data is built from
+        revision = datalab.revision
+
+        datasources = retrieve_datasources(datalab.steps)
+        is_unchanged = datalab.snapshots and all(
+            datasource.snapshot
+            and datasource.snapshot == datalab.snapshots.get(datasource_id)
+            for (datasource_id, datasource) in datasources.items()
+        )
+        if is_unchanged:
+            return False
+
+        snapshots = {}
+        data = combine_data(
+            datalab.steps, datalab.id, snapshots, previous=load_data(datalab)
+        )
+        if store_data(datalab, data, revision):
+            Datalab.objects(id=datalab.id).update(set__snapshots=snapshots)
+            return True
+
+    raise Exception("The DataLab was modified repeatedly while being rebuilt")
+
+
+def retrieve_datasources(steps):
+    datasource_ids = {
+        step["datasource"]["id"] for step in steps if step["type"] == "datasource"
+    }
+    datasources = {
+        str(datasource.id): datasource
+        for datasource in Datasource.objects(id__in=list(datasource_ids))
+    }
+
+    for datasource_id in datasource_ids:
+        if datasource_id not in datasources:
+            raise Datasource.DoesNotExist(f"Datasource {datasource_id} does not exist")
+
+    return datasources
+
+
+def load_datasources(steps, datasources):
+    fields = defaultdict(list)
+    for step in steps:
+        if step["type"] == "datasource":
+            module = step["datasource"]
+            for field in [module["primary"], *module["fields"]]:
+                if field not in fields[module["id"]]:
+                    fields[module["id"]].append(field)
 
+    return {
+        datasource_id: datasources[datasource_id].to_dataset(fields=datasource_fields)
+        for (datasource_id, datasource_fields) in fields.items()
+    }
+
+
+def partition_field(steps, build_fields):
+    """ Identify the field that the records can be hash-partitioned by in a
+        parallel build, i.e. the field of the first module which every later
+        datasource and form module is joined on. Returns None if there is no
+        such field, or if a module keeps its records which don't match any
+        existing records (as these are only known once every partition has
+        been joined). """
+
+    field = None
+    for step in steps[1:]:
         if step["type"] == "datasource":
             module = step["datasource"]
-            datasource = Datasource.objects.get(id=module["id"])
-            fields = module["fields"]
-            label_map = module["labels"]
-
-            # Populate the data map before merging in this datasource module's data
-            for item in data:
-                # If the item has a value for this module's specified matching field
-                # Note that the matching field uses labels and not the original field names
-                if module["matching"] in item:
-                    match_value = item[module["matching"]]
-                    data_map[match_value].append(item)
-
-            # For each record in this datasource's data, extend the matching record in the data map
-            for item in datasource.data:
-                match_value = item[module["primary"]]
-                # If the match value for this record is in the data map, then extend
-                # each of the matched records with the chosen fields from this datasource module
-                if match_value in data_map:
-                    for matched_record in data_map[match_value]:
-                        for field, value in item.items():
-                            if field in fields:
-                                matched_record[label_map[field]] = value
-
-                # If the match value is not in the data map, then there is a discrepency.
-                # The user would have been prompted on how to deal with discrepencies after they
-                # chose the matching field for this module in the model interface of the DataLab
-                else:
-                    # If the primary discrepency setting is set to True, then the user wants to keep
-                    # the record even with values missing for the previous modules
-                    if (
-                        "discrepencies" in module
-                        and module["discrepencies"] is not None
-                        and "primary" in module["discrepencies"]
-                        and module["discrepencies"]["primary"]
-                    ):
-                        new_record = {}
-                        for field, value in item.items():
-                            if field in fields:
-                                new_record[label_map[field]] = value
-                        data_map[match_value].append(new_record)
-
-            # If the matching discrepency setting is set to True, then the user wants to keep
-            # any records whose matching keys do not exist in this datasource module.
-            if not (
-                "discrepencies" in module
-                and module["discrepencies"] is not None
-                and "matching" in module["discrepencies"]
-                and module["discrepencies"]["matching"]
-            ):
-                primary_records = {
-                    item.get(module["primary"]) for item in datasource.data
-                }
-                matching_records = {item.get(module["matching"]) for item in data}
-                for record in matching_records - primary_records:
-                    data_map.pop(record, None)
-
-        if step["type"] == "form" and "data" in step["form"]:
-            module = step["form"]
-
-            # Populate the data map before merging in this form module's data
-            for item in data:
-                if module["primary"] in item:
-                    match_value = item[module["primary"]]
-                    data_map[match_value].append(item)
-
-            # Update keys in the data map with this form's data
-            for item in module["data"]:
-                match_value = item[module["primary"]]
-                if match_value in data_map:
-                    for matched_record in data_map[match_value]:
-                        matched_record.update(item)
-
-        if step["type"] == "computed":
-            module = step["computed"]
-
-            for item in data:
-                for field in module["fields"]:
-                    item[field["name"]] = calculate_computed_field(
-                        field["formula"], item, build_fields, tracking_feedback_data
+            if discrepency_setting(module, "primary"):
+                return None
+            join_field = module["matching"]
+        elif step["type"] == "form" and "data" in step["form"]:
+            join_field = step["form"]["primary"]
+        else:
+            continue
+
+        if field is not None and join_field != field:
+            return None
+        field = join_field
+
+    # The field must come from the first module, and must not be overwritten by
+    # later modules, otherwise the records would need to be repartitioned
+    if field is None or field not in build_fields[0]:
+        return None
+    if any(field in fields for fields in build_fields[1:]):
+        return None
+
+    return field
+
+
+def parallel_build(steps, datasets, build_fields, tracking_feedback_data, workers):
+    """ Build the data of a DataLab by hash-partitioning the records of the first
+        module by the field that the later modules are joined on, and building
+        each partition in a pool of processes. The partitions are merged in the
+        order of the records of a serial build. Returns None if the data must
+        instead be built serially. """
+
+    field = partition_field(steps, build_fields)
+    if field is None:
+        return None
+
+    dataset = apply_step(
+        None, steps[0], datasets, build_fields, tracking_feedback_data, None
+    )
+    if len(dataset) < DATALAB_PARALLEL_BUILD["MIN_RECORDS"]:
+        return None
+
+    # The first join groups the records by key, in the order that the keys first
+    # appear. As every module is joined on the same key, the order of a serial
+    # build is that of the position where each record's key first appears, and
+    # then the position of the record itself.
+    first_positions = {}
+    key_positions = np.empty(len(dataset), dtype=np.int64)
+    for (index, key) in enumerate(dataset[field].values):
+        key_positions[index] = first_positions.setdefault(key, index)
+
+    numbers = partition_numbers(dataset[field].values, workers)
+    partitions = []
+    for number in range(workers):
+        positions = np.flatnonzero(numbers == number)
+        partitions.append((dataset.take(positions), positions))
+
+    # The pool is forked, so that the partitions and the datasets of the modules
+    # are inherited by the workers rather than being serialized
+    state = (steps, partitions, datasets, build_fields, tracking_feedback_data)
+    try:
+        with get_context("fork").Pool(
+            workers, initializer=init_partition_worker, initargs=(state,)
+        ) as pool:
+            results = pool.map(build_partition, range(workers), chunksize=1)
+    except (AssertionError, OSError, ValueError):
+        # E.g. daemonic processes (such as those of a prefork Celery pool) can't
+        # have children
+        return None
+
+    # If a join doesn't match any records at all, then a serial build leaves the
+    # records as they were, which the partitions can't know individually
+    join_counts = zip(*(counts for (_, _, counts) in results))
+    if not all(sum(counts) for counts in join_counts):
+        return None
+
+    types = {name: column.type for (name, column) in results[0][0].columns.items()}
+    merged = Dataset.concat([partition for (partition, _, _) in results], types=types)
+    positions = np.concatenate([positions for (_, positions, _) in results])
+    return merged.take(np.lexsort((positions, key_positions[positions])))
+
+
+# The state of a parallel build, which is inherited by the pool's workers
+partition_state = None
+
+
+def init_partition_worker(state):
+    global partition_state
+    partition_state = state
+
+
+def partition_numbers(keys, workers):
+    """ Assign each of the given keys to one of the partitions by its hash, i.e.
+        records with equal keys are always in the same partition """
+
+    return np.fromiter(
+        (hash(key) % workers for key in keys), dtype=np.int64, count=len(keys)
+    )
+
+
+def build_partition(number):
+    """ Apply the steps after the first module to a partition of the records,
+        returning the built partition along with the position of each record
+        in the first module, and the number of records joined by each join """
+
+    (steps, partitions, datasets, build_fields, tracking_feedback_data) = (
+        partition_state
+    )
+    (dataset, positions) = partitions[number]
+    join_counts = []
+
+    # Only the records of each datasource whose keys belong to this partition can
+    # be joined, so the other records are left out of the join
+    sources = {}
+
+    for step in steps[1:]:
+        if step["type"] == "datasource" or (
+            step["type"] == "form" and "data" in step["form"]
+        ):
+            step_datasets = datasets
+            if step["type"] == "datasource":
+                module = step["datasource"]
+                source_key = (module["id"], module["primary"])
+                if source_key not in sources:
+                    source = datasets[module["id"]]
+                    numbers = partition_numbers(
+                        source[module["primary"]].values, len(partitions)
                     )
+                    sources[source_key] = source.take(np.flatnonzero(numbers == number))
+                step_datasets = {module["id"]: sources[source_key]}
+
+            right, left_indices, right_indices = join_module(
+                dataset, step, step_datasets
+            )
+            dataset = merge_datasets(
+                dataset, right, left_indices, right_indices, keep_empty=True
+            )
+            positions = positions[left_indices]
+            join_counts.append(len(left_indices))
+        else:
+            dataset = apply_step(
+                dataset, step, datasets, build_fields, tracking_feedback_data, None
+            )
+
+    return dataset, positions, join_counts
+
+
+# Process-wide cache of the datasets built by DataLab steps, keyed by the steps
+# (up to and including a given step) and the versions of their inputs
+builds = OrderedDict()
+builds_lock = threading.Lock()
+
+
+def build_cache_keys(steps, datasources, build_fields, tracking_feedback_data):
+    """ Generate the cache key of each prefix of the steps, i.e. the key of the
+        n-th step identifies the dataset built by the first n steps """
+
+    keys = []
+    key = ""
+    for step in steps:
+        if isinstance(step, EmbeddedDocument):
+            step = step.to_mongo().to_dict()
+
+        # Form data is part of the step itself, whereas datasources are identified
+        # by their current snapshot (or version, if they don't have one yet).
+        # Computed fields can also aggregate the fields of any step, along with
+        # the tracking and feedback data of the DataLab's actions.
+        inputs = None
+        if step["type"] == "datasource":
+            datasource = datasources[step["datasource"]["id"]]
+            inputs = [datasource.snapshot, datasource.version, datasource.lastUpdated]
+        elif step["type"] == "computed":
+            inputs = [build_fields, tracking_feedback_data]
+
+        key = hashlib.sha1(
+            json.dumps([key, step, inputs], sort_keys=True, default=str).encode()
+        ).hexdigest()
+        keys.append(key)
+
+    return keys
+
+
+def get_cached_build(key):
+    with builds_lock:
+        if key not in builds:
+            return None
+        builds.move_to_end(key)
+        return builds[key]
+
+
+def cache_build(key, dataset):
+    """ Add a built dataset to the cache, evicting the least recently used
+        datasets if the cache is over its budget """
+
+    size = len(dataset) * len(dataset.fields)
+    if size > DATALAB_BUILD_CACHE["MAX_CELLS"]:
+        return
+
+    with builds_lock:
+        builds[key] = dataset
+        builds.move_to_end(key)
+
+        total_size = sum(len(cached) * len(cached.fields) for cached in builds.values())
+        while (
+            len(builds) > DATALAB_BUILD_CACHE["MAX_ENTRIES"]
+            or total_size > DATALAB_BUILD_CACHE["MAX_CELLS"]
+        ):
+            _, evicted = builds.popitem(last=False)
+            total_size -= len(evicted) * len(evicted.fields)
+
+
+def discrepency_setting(module, setting):
+    return bool(
+        "discrepencies" in module
+        and module["discrepencies"] is not None
+        and setting in module["discrepencies"]
+        and module["discrepencies"][setting]
+    )
+
+
+def column_values(dataset, field):
+    if field in dataset:
+        return dataset[field].values
+
+    return object_array([MISSING] * len(dataset))
+
+
+def merge_duplicate_records(dataset, field):
+    """ Merge the records of a dataset that have the same value for the given
+        field into a single record (in place of the first of them), field by
+        field, in which the values of later records take precedence unless they
+        are missing. This is how records with duplicate keys were combined when
+        each was merged into the matching records in turn. """
+
+    keys = column_values(dataset, field)
+    groups = {}
+    record_groups = np.fromiter(
+        (groups.setdefault(key, len(groups)) for key in keys),
+        dtype=np.int64,
+        count=len(keys),
+    )
+    if len(groups) == len(keys):
+        return dataset
+
+    positions = np.arange(len(keys), dtype=np.int64)
+    first = np.full(len(groups), len(keys), dtype=np.int64)
+    np.minimum.at(first, record_groups, positions)
+
+    columns = []
+    for (name, column) in dataset.columns.items():
+        # The last record of each group that has a value for the field
+        present = column.present
+        indices = first.copy()
+        np.maximum.at(indices, record_groups[present], positions[present])
+        columns.append((name, column.take(indices)))
+
+    return Dataset(columns, len(groups))
+
+
+def join_indices(left_keys, right_keys, keep_left, keep_right):
+    """ Join two columns of keys using a hash index of the right keys, returning
+        the indices of the joined records on the left and right (where -1 denotes
+        a record with no counterpart). Left records without a key are dropped,
+        and the joined records are grouped by key, in the order that the keys
+        first appear (on the left, and then on the right). The right keys are
+        expected to be unique (see merge_duplicate_records). """
+
+    # Index of the right keys, built once for all of the left records
+    right_index = {key: index for (index, key) in enumerate(right_keys)}
+    right_index.pop(MISSING, None)
+
+    # Assign each left key a group number in the order in which they first appear
+    groups = {}
+    left_indices = []
+    left_groups = []
+    for (index, key) in enumerate(left_keys):
+        if key is MISSING:
+            continue
+        left_indices.append(index)
+        left_groups.append(groups.setdefault(key, len(groups)))
+
+    left_groups = np.array(left_groups, dtype=np.int64)
+    order = np.argsort(left_groups, kind="mergesort")
+    left_indices = np.array(left_indices, dtype=np.int64)[order]
+
+    # Each distinct key is only looked up in the index once
+    group_matches = np.array(
+        [right_index.get(key, -1) for key in groups], dtype=np.int64
+    )
+    right_indices = group_matches[left_groups[order]]
+
+    if not keep_left:
+        matched = right_indices >= 0
+        left_indices = left_indices[matched]
+        right_indices = right_indices[matched]
+
+    if keep_right:
+        unmatched = [
+            index
+            for (key, index) in right_index.items()
+            if key not in groups
+        ]
+        left_indices = np.concatenate(
+            [left_indices, np.full(len(unmatched), -1, dtype=np.int64)]
+        )
+        right_indices = np.concatenate(
+            [right_indices, np.array(unmatched, dtype=np.int64)]
+        )
+
+    return left_indices, right_indices
 
-        # Create the data (list of dicts, with each dict representing a record) based on the updated data map
-        if len(data_map):
-            data = []
-            for match in data_map.values():
-                for item in match:
-                    data.append(item)
 
-    return data
+def merge_datasets(left, right, left_indices, right_indices, keep_empty=False):
+    """ Combine the records at the given indices of two datasets, in which the
+        values on the right take precedence (unless they are missing) """
+
+    # If there are no joined records at all, then the dataset is left as is
+    # (unless an empty dataset is explicitly wanted, e.g. for a partition)
+    if not len(left_indices) and not keep_empty:
+        return left
+
+    merged = left.take(left_indices)
+    for (field, column) in right.columns.items():
+        column = column.take(right_indices)
+        if field in merged:
+            values = merged[field].values
+            present = column.present
+            values[present] = column.values[present]
+            column = Column(values, column.type)
+        merged.add_column(field, column)
+
+    return merged
 
 
 def update_form_data(
@@ -337,10 +1012,6 @@ def update_form_data(
     form = datalab.steps[step].form
     web_form = form["webForm"]
 
-    datalab_data_map = {
-        item[form.primary]: item for item in datalab.data if form.primary in item
-    }
-
     not_accessible = (
         (is_web_form and not web_form or (web_form and not web_form["active"]))
         or (
@@ -369,14 +1040,14 @@ def update_form_data(
         if is_web_form and web_form and web_form["active"]:
             permission_field = web_form["permission"]
             if web_form["showAll"]:
-                permissable_users = {
-                    item.get(permission_field).strip() for item in datalab.data
-                }
-                has_access = request_user in permissable_users
-            else:
-                has_access = (
-                    request_user == datalab_data_map[primary][permission_field].strip()
+                has_access = bool(
+                    find_permitted_records(
+                        datalab, permission_field, request_user, limit=1
+                    )
                 )
+            else:
+                (_, record) = find_records(datalab, form.primary, primary)[-1]
+                has_access = request_user == record[permission_field].strip()
 
     # Confirm whether the user has access after the above checks have been performed
     if not has_access:
@@ -391,19 +1062,30 @@ def update_form_data(
         previous_value = (
             form_data_map[primary][field] if field in form_data_map[primary] else None
         )
-        form_data_map[primary].update({field: value})
-    else:
-        form_data_map[primary] = {form.primary: primary, field: value}
-
-    form_data = [value for value in form_data_map.values()]
 
-    kw = {f"set__steps__{step}__form__data": form_data}
-    Datalab.objects(id=datalab.id).update(**kw)
-    datalab.reload()
-
-    data = combine_data(datalab.steps, datalab.id)
-    Datalab.objects(id=datalab.id).update(set__data=data)
-    datalab.reload()
+    # Patch the single cell (and the records that it affects) where possible,
+    # otherwise update the whole form and rebuild the data
+    if not patch_form_data(datalab, step, field, primary, value):
+        if primary in form_data_map:
+            form_data_map[primary].update({field: value})
+        else:
+            form_data_map[primary] = {form.primary: primary, field: value}
+
+        form_data = [value for value in form_data_map.values()]
+
+        kw = {f"set__steps__{step}__form__data": form_data, "inc__revision": 1}
+        Datalab.objects(id=datalab.id).update(**kw)
+        datalab.reload()
+
+        # Only the form data has changed, so the previous data can be used to avoid
+        # recomputing the computed fields of unaffected records
+        snapshots = {}
+        data = combine_data(
+            datalab.steps, datalab.id, snapshots, previous=load_data(datalab)
+        )
+        Datalab.objects(id=datalab.id).update(set__snapshots=snapshots)
+        store_data(datalab, data)
+        datalab.reload()
 
     audit = AuditSerializer(
         data={
@@ -427,6 +1109,265 @@ def update_form_data(
     return datalab
 
 
+def patch_form_data(datalab, step, field, primary, value):
+    """ Update a single cell of a form, along with the records of the DataLab's
+        data that it is merged into (and the computed fields of those records
+        which depend on it), in a single atomic update. Returns False if the
+        data must instead be rebuilt, i.e. if the edit could affect how the
+        records are combined, or if the data has changed in the meantime. """
+
+    steps = datalab.steps
+    form = steps[step].form
+
+    # If a field is produced by more than one step, then later steps could
+    # override the edited value (or the values that computed fields depend on)
+    build_fields = step_build_fields(steps)
+    all_fields = [name for fields in build_fields for name in fields]
+    if field not in build_fields[step] or len(all_fields) != len(set(all_fields)):
+        return False
+
+    # Likewise if the edited field is used to match the records of later steps
+    for later_step in steps[step + 1 :]:
+        if later_step.type == "datasource":
+            join_field = later_step.datasource.matching
+        elif later_step.type == "form":
+            join_field = later_step.form.primary
+        else:
+            continue
+        if join_field == field:
+            return False
+
+    matches = find_records(datalab, form.primary, primary)
+    indices = [index for (index, _) in matches]
+    records = [dict(record) for (_, record) in matches]
+    for record in records:
+        record[field] = value
+
+    # Re-evaluate the computed fields of the affected records which depend on
+    # the edited field
+    changed = evaluate_dependent_fields(datalab, build_fields, records, {field}, step)
+
+    # Only apply the update if the form row and the records are still where they
+    # were read from, as the indices are used to address them
+    form_path = f"steps.{step}.form.data"
+    query = {"_id": datalab.id}
+    update = {"$set": {}}
+
+    form_index = next(
+        (
+            index
+            for (index, item) in enumerate(form.data)
+            if item.get(form.primary, MISSING) == primary
+        ),
+        None,
+    )
+    if form_index is not None:
+        query[f"{form_path}.{form_index}.{form.primary}"] = primary
+        update["$set"][f"{form_path}.{form_index}.{field}"] = value
+    else:
+        query[f"{form_path}.{form.primary}"] = {"$ne": primary}
+        update["$push"] = {form_path: {form.primary: primary, field: value}}
+
+    # Records which are stored row by row are updated separately, once the form
+    # has been updated (provided that the data hasn't been rebuilt since)
+    if datalab.rowVersion:
+        query["rowVersion"] = datalab.rowVersion
+    else:
+        for (index, record) in zip(indices, records):
+            query[f"data.{index}.{form.primary}"] = primary
+            for name in changed:
+                if name in record:
+                    update["$set"][f"data.{index}.{name}"] = record[name]
+
+    if not update["$set"]:
+        del update["$set"]
+
+    # Any build which started before this update is now out of date
+    update["$inc"] = {"revision": 1}
+
+    result = Datalab._get_collection().update_one(query, update)
+    if not result.matched_count:
+        return False
+
+    if datalab.rowVersion and not update_records(
+        datalab, indices, records, changed, form.primary, [primary] * len(indices)
+    ):
+        return False
+
+    # Reflect the update in the DataLab instance, rather than reloading it
+    if form_index is not None:
+        form.data[form_index][field] = value
+    else:
+        form.data.append({form.primary: primary, field: value})
+
+    if not datalab.rowVersion:
+        for (index, record) in zip(indices, records):
+            datalab.data[index].update({name: record[name] for name in changed})
+
+    return True
+
+
+def evaluate_dependent_fields(datalab, build_fields, records, changed, step):
+    """ Re-evaluate the computed fields of the given records which depend on the
+        changed fields of a step (directly, or through other computed fields).
+        Each is evaluated against the fields that were available to it during
+        the build. Returns the changed fields, including the computed fields. """
+
+    steps = datalab.steps
+    changed = set(changed)
+    tracking_feedback_data = None
+    for step_index in range(step + 1, len(steps)):
+        if steps[step_index].type != "computed" or not records:
+            continue
+
+        available = {name for fields in build_fields[:step_index] for name in fields}
+        for computed_field in steps[step_index].computed.fields:
+            inputs = computed_field_inputs(computed_field.formula, build_fields)
+            if inputs is None or changed.intersection(inputs):
+                if tracking_feedback_data is None:
+                    tracking_feedback_data = retrieve_tracking_feedback_data(datalab.id)
+
+                evaluate = compile_computed_field(computed_field.formula, build_fields)
+                values = evaluate(
+                    Dataset.from_rows(records, fields=list(available)),
+                    tracking_feedback_data,
+                )
+                for (record, computed_value) in zip(records, values):
+                    record[computed_field.name] = computed_value
+                changed.add(computed_field.name)
+
+            available.add(computed_field.name)
+
+    return changed
+
+
+def patch_datasource_data(datalab, datasource_id, since, updated):
+    """ Update the records of a DataLab that were combined from the rows of a
+        datasource which were updated by an incremental refresh (given by their
+        primary key), along with the computed fields of those records which
+        depend on them, rather than rebuilding the data. The data must have
+        been built from the snapshot of the datasource that was refreshed
+        (since). Returns False if the data must instead be rebuilt, i.e. if the
+        updates could affect how the records are combined, if rows were
+        inserted or deleted, or if the data has changed in the meantime. """
+
+    steps = datalab.steps
+    datasource = Datasource.objects.get(id=datasource_id)
+
+    # The data must otherwise be up to date, i.e. built from the datasource's
+    # snapshot prior to the refresh and the current snapshot of the others
+    datasources = retrieve_datasources(steps)
+    snapshots = {
+        other_id: other.snapshot for (other_id, other) in datasources.items()
+    }
+    expected = {**snapshots, datasource_id: since}
+    if not since or not datalab.snapshots or datalab.snapshots != expected:
+        return False
+
+    # The updated rows must be combined by a single step, on the primary key by
+    # which they were identified (so that they are still matched by the same
+    # records), and their fields mustn't be produced by other steps (or else
+    # later steps could override them)
+    datasource_steps = [
+        index
+        for (index, step) in enumerate(steps)
+        if step.type == "datasource" and step.datasource.id == datasource_id
+    ]
+    if len(datasource_steps) != 1:
+        return False
+
+    step = datasource_steps[0]
+    module = steps[step].datasource
+    if module.primary != datasource.primaryKey:
+        return False
+
+    build_fields = step_build_fields(steps)
+    all_fields = [name for fields in build_fields for name in fields]
+    if len(all_fields) != len(set(all_fields)):
+        return False
+
+    # The records of the first step are identified by its primary key (if it is
+    # one of its fields), and those of later steps by the field they're matched
+    # on. Records which are kept despite not matching cannot be identified.
+    if step == 0:
+        if module.primary not in module.fields:
+            return False
+        key_field = module.labels[module.primary]
+    else:
+        if discrepency_setting(module, "primary"):
+            return False
+        key_field = module.matching
+
+    # The fields of the step which are used to match the records of later steps
+    join_fields = set()
+    for later_step in steps[step + 1 :]:
+        if later_step.type == "datasource":
+            join_fields.add(later_step.datasource.matching)
+        elif later_step.type == "form":
+            join_fields.add(later_step.form.primary)
+    join_fields.intersection_update(build_fields[step])
+
+    # Only the updated rows of the current version of the data are read, each
+    # of which must still have all of the fields used by the step
+    rows = {}
+    if updated:
+        query = {**datasource.row_query(), "key": {"$in": updated}}
+        cursor = DatasourceRow._get_collection().find(query, {"key": 1, "data": 1})
+        rows = {row["key"]: row["data"] for row in cursor}
+    if len(rows) != len(set(updated)) or any(
+        field not in row for row in rows.values() for field in module.fields
+    ):
+        return False
+
+    matches = match_records(datalab, key_field, list(rows))
+    indices = [index for (index, _) in matches]
+    records = [dict(record) for (_, record) in matches]
+    for record in records:
+        row = rows[record[key_field]]
+        record.update({module.labels[field]: row[field] for field in module.fields})
+
+    # Likewise if the values that later steps are matched on have been updated
+    if any(
+        record.get(field, MISSING) != original.get(field, MISSING)
+        for (record, (_, original)) in zip(records, matches)
+        for field in join_fields
+    ):
+        return False
+
+    changed = evaluate_dependent_fields(
+        datalab, build_fields, records, build_fields[step], step
+    )
+
+    # Records which are stored row by row are updated first, each only if it is
+    # still where it was read from (i.e. the data hasn't been rebuilt since)
+    if datalab.rowVersion:
+        keys = [record[key_field] for record in records]
+        if not update_records(datalab, indices, records, changed, key_field, keys):
+            return False
+
+    # The data is only marked as built from the current snapshot if it hasn't
+    # been rebuilt or edited since it was read (otherwise it is rebuilt)
+    query = {
+        "_id": datalab.id,
+        "revision": {"$not": {"$gt": datalab.revision}},
+        f"snapshots.{datasource_id}": since,
+    }
+    update = {
+        "$set": {f"snapshots.{datasource_id}": datasource.snapshot},
+        "$inc": {"revision": 1},
+    }
+    if datalab.rowVersion:
+        query["rowVersion"] = datalab.rowVersion
+    else:
+        for (index, record) in zip(indices, records):
+            query[f"data.{index}.{key_field}"] = record[key_field]
+            for name in changed:
+                if name in record:
+                    update["$set"][f"data.{index}.{name}"] = record[name]
+
+    return bool(Datalab._get_collection().update_one(query, update).matched_count)
+
+
 def retrieve_form_data(datalab, step, request_user):
     is_owner = request_user == datalab.container.owner
     is_shared = request_user in datalab.container.sharing
@@ -439,10 +1380,8 @@ def retrieve_form_data(datalab, step, request_user):
     ):
         return {"error": "This form does not exist"}
 
-    # Convert the document to a format that is JSON serializable
-    datalab = datalab.to_mongo()
-
-    form = datalab["steps"][step]["form"]
+    # Convert the form to a format that is JSON serializable
+    form = datalab.steps[step].form.to_mongo()
     web_form = form["webForm"] if "webForm" in form else None
 
     not_accessible = (
@@ -465,19 +1404,19 @@ def retrieve_form_data(datalab, step, request_user):
     for field in form["fields"]:
         columns.append(field["name"])
 
-    data = []
-    permission_field = web_form["permission"]
-    permissable_users = {item.get(permission_field) for item in datalab["data"]}
+    # Only the records with the user in their permission field are retrieved,
+    # unless the user has access to every record
+    if has_access:
+        items = iter_data(datalab)
+    else:
+        permission_field = web_form["permission"]
+        permitted = find_permitted_records(datalab, permission_field, request_user)
+        if web_form["showAll"] and permitted:
+            items = iter_data(datalab)
+        else:
+            items = (item for (_, item) in permitted)
 
-    for (index, item) in enumerate(datalab["data"]):
-        if (
-            has_access
-            or web_form["showAll"]
-            and request_user in permissable_users
-            or item[permission_field].strip() == request_user
-        ):
-            record = {field: item.get(field) for field in columns}
-            data.append(record)
+    data = [{field: item.get(field) for field in columns} for item in items]
 
     if len(data) == 0:
         return {"error": "You are not authorized to access this form"}
@@ -491,3 +1430,112 @@ def retrieve_form_data(datalab, step, request_user):
         "layout": web_form["layout"],
         "is_owner_or_shared": has_access,
     }
+
+
+def query_data(
+    datalab,
+    page=1,
+    page_size=50,
+    sort_field=None,
+    sort_order=None,
+    filters=None,
+    search=None,
+):
+    """ Select a single page of the records of a DataLab, after filtering them
+        (by a search term across all fields, and/or by a list of terms per field)
+        and sorting them by a field. A page size of 0 selects every record.
+        Records match a term if each of its words starts a word of the field (or
+        of any field, for the search term). Only records which are stored row by
+        row are filtered and sorted by way of indexes, whereas records which are
+        stored inline are read in full and filtered and sorted in turn. """
+
+    conditions = []
+    for (field, terms) in (filters or {}).items():
+        if not isinstance(terms, list):
+            terms = [terms]
+        terms = [search_words(str(term)) for term in terms if term is not None]
+        terms = [words for words in terms if words]
+        if terms:
+            conditions.append((field, terms))
+
+    search = search_words(str(search or ""))
+    descending = sort_order == "descend"
+
+    def bounds(total):
+        return page_bounds(page, page_size, total)
+
+    # Pages of the unfiltered and unsorted records are read directly, which for
+    # records that are stored row by row is a range of the (indexed) positions
+    if not (conditions or search or sort_field):
+        total = count_data(datalab)
+        (page, start, stop) = bounds(total)
+        return {
+            "records": data_slice(datalab, start, stop),
+            "total": total,
+            "unfilteredTotal": total,
+            "page": page,
+            "pageSize": page_size,
+        }
+
+    # Records that are stored row by row are filtered, sorted and paged by way of
+    # the indexes of their words and ranks
+    if datalab.rowVersion and rows_are_queryable(datalab):
+        (records, total, page) = query_rows(
+            datalab, conditions, search, sort_field, descending, bounds
+        )
+        return {
+            "records": records,
+            "total": total,
+            "unfilteredTotal": count_data(datalab),
+            "page": page,
+            "pageSize": page_size,
+        }
+
+    # Records which are stored inline are excluded from the DataLab retrieved
+    # by the view, and are only loaded here
+    if not datalab.rowVersion:
+        datalab.reload("data")
+
+    def words(value):
+        return search_words(display_value(value))
+
+    unfiltered_total = 0
+    records = []
+    for record in iter_data(datalab):
+        unfiltered_total += 1
+        is_match = all(
+            any(words_match(term, words(record.get(field))) for term in terms)
+            for (field, terms) in conditions
+        ) and words_match(
+            search, [word for value in record.values() for word in words(value)]
+        )
+        if is_match:
+            records.append(record)
+
+    # Records without a value for the sort field are always listed last
+    if sort_field:
+        field_type = field_types(datalab.steps).get(sort_field)
+        keys = [sort_key(record.get(sort_field), field_type) for record in records]
+        records = [records[index] for index in sorted_indices(keys, descending)]
+
+    total = len(records)
+    (page, start, stop) = bounds(total)
+
+    return {
+        "records": records[start:stop],
+        "total": total,
+        "unfilteredTotal": unfiltered_total,
+        "page": page,
+        "pageSize": page_size,
+    }
+
+
+def page_bounds(page, page_size, total):
+    """ Tuple of (page, start, stop) of a page of records, in which the page is
+        limited to the last page that has records """
+
+    if not page_size:
+        return 1, 0, total
+
+    page = max(1, min(page, (total + page_size - 1) // page_size))
+    return page, (page - 1) * page_size, page * page_size
@@ -9,7 +9,14 @@ import json
 from .serializers import DatalabSerializer
 from .permissions import DatalabPermissions
 from .models import Datalab
-from .utils import bind_column_types, combine_data, update_form_data, retrieve_form_data
+from .utils import (
+    bind_column_types,
+    combine_data,
+    update_form_data,
+    retrieve_form_data,
+    query_data,
+)
+from .storage import store_data, load_data
 
 from container.views import ContainerViewSet
 from datasource.models import Datasource
@@ -29,6 +36,10 @@ class DatalabViewSet(viewsets.ModelViewSet):
         # Retrieve only the DataLabs that belong to these containers
         datalabs = Datalab.objects(container__in=containers)
 
+        # The data itself is only retrieved one page at a time, via the data route
+        if self.action in ["list", "retrieve", "data"]:
+            datalabs = datalabs.exclude("data")
+
         return datalabs
 
     def perform_create(self, serializer):
@@ -42,7 +53,8 @@ class DatalabViewSet(viewsets.ModelViewSet):
 
         steps = self.request.data["steps"]
         steps = bind_column_types(steps)
-        data = combine_data(steps)
+        snapshots = {}
+        data = combine_data(steps, snapshots=snapshots)
 
         order = []
         for (step_index, step) in enumerate(steps):
@@ -55,7 +67,8 @@ class DatalabViewSet(viewsets.ModelViewSet):
                     }
                 )
 
-        datalab = serializer.save(steps=steps, data=data, order=order)
+        datalab = serializer.save(steps=steps, snapshots=snapshots, order=order)
+        store_data(datalab, data)
 
         audit = AuditSerializer(
             data={
@@ -84,7 +97,8 @@ class DatalabViewSet(viewsets.ModelViewSet):
         steps = self.request.data["steps"]
         steps = bind_column_types(steps)
 
-        data = combine_data(steps, datalab.id)
+        snapshots = {}
+        data = combine_data(steps, datalab.id, snapshots)
 
         order = [
             {
@@ -125,7 +139,8 @@ class DatalabViewSet(viewsets.ModelViewSet):
                 if not already_exists:
                     order.append({"stepIndex": step_index, "field": field})
 
-        serializer.save(steps=steps, data=data, order=order)
+        serializer.save(steps=steps, snapshots=snapshots, order=order)
+        store_data(serializer.instance, data)
 
         # Identify the changes made to the datasource
         diff = {"steps": []}
@@ -264,7 +279,9 @@ class DatalabViewSet(viewsets.ModelViewSet):
         data = combine_data(partial_build, datalab_id)
         datasource = Datasource.objects.get(id=check_module["id"])
 
-        primary_records = {item[check_module["primary"]] for item in datasource.data}
+        primary_records = {
+            item[check_module["primary"]] for item in datasource.iter_rows()
+        }
         matching_records = {
             item[check_module["matching"]]
             for item in data
@@ -489,6 +506,34 @@ class DatalabViewSet(viewsets.ModelViewSet):
 
         return JsonResponse(serializer.data)
 
+    @detail_route(methods=["get"])
+    def data(self, request, id=None):
+        datalab = self.get_object()
+        self.check_object_permissions(self.request, datalab)
+
+        params = request.query_params
+        try:
+            page = int(params.get("page", 1))
+            page_size = int(params.get("pageSize", 50))
+            filters = json.loads(params.get("filters", "{}"))
+        except ValueError:
+            raise ValidationError("Invalid page or filters")
+
+        if not isinstance(filters, dict):
+            raise ValidationError("Invalid page or filters")
+
+        result = query_data(
+            datalab,
+            page=page,
+            page_size=max(page_size, 0),
+            sort_field=params.get("sortField"),
+            sort_order=params.get("sortOrder"),
+            filters=filters,
+            search=params.get("search"),
+        )
+
+        return JsonResponse(result)
+
     @list_route(methods=["post"])
     def retrieve_form(self, request):
         request_user = request.user.email
@@ -561,13 +606,16 @@ class DatalabViewSet(viewsets.ModelViewSet):
         datalab = self.get_object()
         self.check_object_permissions(self.request, datalab)
 
+        data = load_data(datalab)
+
         datalab = datalab.to_mongo()
         datalab["name"] = datalab["name"] + "_cloned"
         datalab.pop("_id")
 
         serializer = DatalabSerializer(data=datalab)
         serializer.is_valid()
-        serializer.save()
+        serializer.save(snapshots=datalab.get("snapshots", {}))
+        store_data(serializer.instance, data)
 
         audit = AuditSerializer(
             data={
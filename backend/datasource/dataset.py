@@ -0,0 +1,321 @@
+from collections import OrderedDict
+from dateutil import parser
+import numpy as np
+import time
+
+from ontask.settings import DATASOURCE_BATCH_SIZE
+
+
+class Missing:
+    """ Placeholder for a field which is absent from a record, as opposed to a
+        field which is present in the record with a value of None """
+
+    def __repr__(self):
+        return "MISSING"
+
+    def __bool__(self):
+        return False
+
+    def __reduce__(self):
+        # Unpickle as the module-level instance (e.g. in datasets which are built
+        # in another process), so that identity checks against MISSING still work
+        return "MISSING"
+
+
+MISSING = Missing()
+
+
+def object_array(values):
+    """ Create a one-dimensional object array of the given values. Assigning into
+        an empty array prevents NumPy from treating list values as dimensions. """
+
+    values = list(values)
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def cast_number(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def cast_timestamp(value):
+    """ Cast a date to seconds since the epoch, as is done when workflow rules
+        are tested against date fields """
+
+    try:
+        return int(time.mktime(parser.parse(value).timetuple()))
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def cast_values(values, cast):
+    """ Cast an object array of values into a float array, along with a validity
+        mask which is False wherever the value is missing or failed to cast.
+        Each distinct value is only cast once. """
+
+    result = np.zeros(len(values), dtype=np.float64)
+    valid = np.zeros(len(values), dtype=bool)
+    cache = {}
+
+    for (index, value) in enumerate(values):
+        if value is MISSING or value is None:
+            continue
+
+        try:
+            cast_value = cache[value]
+        except KeyError:
+            cast_value = cache[value] = cast(value)
+        except TypeError:
+            # Unhashable values (e.g. lists) are cast without being cached
+            cast_value = cast(value)
+
+        if cast_value is not None:
+            result[index] = cast_value
+            valid[index] = True
+
+    return result, valid
+
+
+class Column:
+    """ A single column of a dataset. The values are stored in a NumPy object
+        array, exactly as they appear in the source records. Number and date
+        columns are additionally cast to typed (float) arrays with a validity
+        mask the first time that they are scanned, so that filters and
+        computations operate on whole arrays rather than casting every value of
+        every record each time. """
+
+    def __init__(self, values, type=None):
+        if not (isinstance(values, np.ndarray) and values.dtype == object):
+            values = object_array(values)
+
+        self.values = values
+        self.type = type
+        self._present = None
+        self._numbers = None
+        self._timestamps = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    @property
+    def present(self):
+        """ Boolean mask of the records which have a value for this column """
+
+        if self._present is None:
+            self._present = np.fromiter(
+                (value is not MISSING for value in self.values),
+                dtype=bool,
+                count=len(self.values),
+            )
+        return self._present
+
+    @property
+    def numbers(self):
+        """ Tuple of (float array, validity mask) of the values cast as numbers """
+
+        if self._numbers is None:
+            # Fast path for columns in which every value can be cast. NumPy casts
+            # None to NaN, so columns containing NaN are cast value by value.
+            try:
+                numbers = self.values.astype(np.float64)
+            except (ValueError, TypeError):
+                numbers = None
+
+            if numbers is not None and not np.isnan(numbers).any():
+                self._numbers = (numbers, np.ones(len(numbers), dtype=bool))
+            else:
+                self._numbers = cast_values(self.values, cast_number)
+        return self._numbers
+
+    @property
+    def timestamps(self):
+        """ Tuple of (float array, validity mask) of the values cast as dates,
+            in seconds since the epoch """
+
+        if self._timestamps is None:
+            self._timestamps = cast_values(self.values, cast_timestamp)
+        return self._timestamps
+
+    def take(self, indices):
+        """ Create a column from the values at the given indices, where an index
+            of -1 denotes a missing value """
+
+        indices = np.asarray(indices, dtype=np.int64)
+        if not len(self.values):
+            return Column(object_array([MISSING] * len(indices)), self.type)
+
+        values = self.values[np.maximum(indices, 0)]
+        values[indices < 0] = MISSING
+        return Column(values, self.type)
+
+
+class Dataset:
+    """ Columnar representation of a list of records (i.e. dicts), in which each
+        field is stored as a Column. A row view is provided for consumers of
+        the records, in which a field is omitted if the record has no value for
+        it (as would be the case for the equivalent dict). """
+
+    def __init__(self, columns=None, length=None):
+        self.columns = OrderedDict(columns or [])
+        if length is None:
+            length = len(next(iter(self.columns.values()))) if self.columns else 0
+        self.length = length
+
+    @classmethod
+    def from_rows(cls, rows, fields=None, types=None):
+        """ Build a dataset from an iterable of records, which is consumed as a
+            stream. If fields are given then only those fields are kept,
+            otherwise all fields are kept (in the order they are encountered). """
+
+        types = types or {}
+        length = 0
+
+        if fields is not None:
+            buffers = OrderedDict((field, []) for field in fields)
+            appenders = [
+                (field, buffer.append) for (field, buffer) in buffers.items()
+            ]
+            for row in rows:
+                for (field, append) in appenders:
+                    append(row.get(field, MISSING))
+                length += 1
+
+        else:
+            buffers = OrderedDict()
+            for row in rows:
+                for (field, value) in row.items():
+                    if field not in buffers:
+                        buffers[field] = [MISSING] * length
+                    buffers[field].append(value)
+                length += 1
+                for buffer in buffers.values():
+                    if len(buffer) < length:
+                        buffer.append(MISSING)
+
+        return cls(
+            [
+                (field, Column(buffer, types.get(field)))
+                for (field, buffer) in buffers.items()
+            ],
+            length,
+        )
+
+    @classmethod
+    def concat(cls, datasets, fields=None, types=None):
+        """ Concatenate datasets (e.g. chunks of the same data) into one dataset,
+            in which a field is missing for the records of any dataset that
+            doesn't have it. If fields are given then only those fields are kept,
+            otherwise all fields are kept. """
+
+        datasets = list(datasets)
+        types = types or {}
+
+        if fields is None:
+            fields = []
+            for dataset in datasets:
+                fields.extend(
+                    field for field in dataset.fields if field not in fields
+                )
+
+        columns = []
+        for field in fields:
+            arrays = [
+                dataset[field].values
+                if field in dataset
+                else object_array([MISSING] * len(dataset))
+                for dataset in datasets
+            ]
+            values = np.concatenate(arrays) if arrays else object_array([])
+            columns.append((field, Column(values, types.get(field))))
+
+        return cls(columns, sum(len(dataset) for dataset in datasets))
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, field):
+        return field in self.columns
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    @property
+    def fields(self):
+        return list(self.columns.keys())
+
+    def add_column(self, field, values, type=None):
+        column = values if isinstance(values, Column) else Column(values, type)
+        if len(column) != self.length:
+            raise ValueError(f"Column {field} does not match the length of the dataset")
+        self.columns[field] = column
+
+    def rename(self, labels):
+        """ Create a dataset in which the fields are renamed using the given map
+            (fields which are not in the map keep their name) """
+
+        return Dataset(
+            [
+                (labels.get(field, field), column)
+                for (field, column) in self.columns.items()
+            ],
+            self.length,
+        )
+
+    def select(self, fields):
+        return Dataset(
+            [(field, self.columns[field]) for field in fields if field in self],
+            self.length,
+        )
+
+    def take(self, indices):
+        """ Create a dataset from the records at the given indices, where an index
+            of -1 denotes a record with no values """
+
+        indices = np.asarray(indices, dtype=np.int64)
+        return Dataset(
+            [(field, column.take(indices)) for (field, column) in self.columns.items()],
+            len(indices),
+        )
+
+    def row(self, index):
+        return {
+            field: column.values[index]
+            for (field, column) in self.columns.items()
+            if column.values[index] is not MISSING
+        }
+
+    def iter_rows(self):
+        fields = self.fields
+        for values in zip(*(column.values for column in self.columns.values())):
+            yield {
+                field: value
+                for (field, value) in zip(fields, values)
+                if value is not MISSING
+            }
+
+        # A dataset with no columns still has records (which are empty)
+        if not self.columns:
+            for _ in range(self.length):
+                yield {}
+
+    def to_rows(self):
+        return list(self.iter_rows())
+
+    def iter_batches(self, batch_size=DATASOURCE_BATCH_SIZE):
+        """ Yield the records in batches, e.g. to be written to a datasource """
+
+        batch = []
+        for row in self.iter_rows():
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
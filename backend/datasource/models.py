@@ -7,18 +7,32 @@ from mongoengine.fields import (
     ReferenceField,
     EmbeddedDocumentField,
     DateTimeField,
+    BaseField,
+    BinaryField,
 )
+from bson import ObjectId
 from datetime import datetime
+from itertools import chain, groupby
 
 from container.models import Container
 
+from .dataset import Column, Dataset
 from .utils import (
+    ColumnTypeInference,
+    batch_rows,
+    compress_column,
+    decompress_column,
+    get_s3_object,
+    hash_row,
+    peek_batches,
     retrieve_csv_data,
     retrieve_excel_data,
     retrieve_file_from_s3,
     retrieve_sql_data,
 )
 
+from ontask.settings import DATASOURCE_BATCH_SIZE, DATASOURCE_SNAPSHOT_RETENTION
+
 
 class Connection(EmbeddedDocument):
     dbType = StringField(
@@ -65,24 +79,475 @@ class Datasource(Document):
     container = ReferenceField(Container, required=True, reverse_delete_rule=2)
     name = StringField(required=True)
     connection = EmbeddedDocumentField(Connection)
-    data = ListField(DictField())
     schedule = EmbeddedDocumentField(Schedule, null=True)
     # Last time the data was updated
     lastUpdated = DateTimeField(default=datetime.utcnow)
     fields = ListField(StringField())
     types = DictField()
+    # The confidence of the inferred type and the proportion of null values of
+    # each field, as determined when the data was last written
+    columnStats = DictField()
+    # The rows of the datasource are stored in the DatasourceRow collection,
+    # keyed by the datasource and the version of the data that they belong to.
+    # Version 0 denotes a datasource whose rows are still stored inline (in the
+    # legacy "data" attribute of the document), or which has no data yet.
+    # A row belongs to the version that wrote it and to every later version,
+    # until the version that it was removed in (see row_query).
+    version = IntField(default=0)
+    # Incremented atomically in order to claim the version of the next write
+    latestVersion = IntField(default=0)
+    rowCount = IntField(default=0)
+    # ETag and size (in bytes) of the object that the data of an s3 bucket file
+    # was last retrieved from, so that unchanged files are not re-imported
+    etag = StringField(null=True)
+    fileSize = IntField(null=True)
+    # If a primary key is specified, then the datasource is refreshed incrementally,
+    # i.e. only the rows which have been inserted, updated or deleted are written
+    primaryKey = StringField(null=True)
+    # The primary key that the rows of the current version were keyed by when
+    # written, which must match the primary key for a refresh to be incremental
+    keyedBy = StringField(null=True)
+    # The number of rows inserted, updated and deleted by the last refresh
+    lastChanges = DictField()
+    # Each write of the data is also kept as a compressed snapshot (in the
+    # DatasourceSnapshot collection), of which the most recent are retained.
+    # Snapshot 0 denotes a datasource which has no snapshot yet.
+    snapshot = IntField(default=0)
+    latestSnapshot = IntField(default=0)
+
+    # Legacy documents may still contain the inline "data" attribute
+    meta = {"strict": False}
+
+    def row_query(self, version=None):
+        """ Query of the rows of the given version of the data (by default the
+            current version), i.e. the rows written by that or an earlier
+            version which had not been removed as of that version """
+
+        version = version or self.version
+        return {
+            "datasource": self.id,
+            "version": {"$lte": version},
+            "removedIn": {"$not": {"$lte": version}},
+        }
+
+    def iter_rows(self, fields=None):
+        """ Lazily yield the rows of the current version of the data, reading
+            them from the application database in batches. If fields are given
+            then the rows are projected to only those fields where possible. """
+
+        if not self.version:
+            legacy = Datasource._get_collection().find_one(
+                {"_id": self.id}, {"data": 1}
+            )
+            yield from (legacy or {}).get("data", [])
+            return
+
+        # Field names containing a dot cannot be used in a projection
+        projection = ["data"]
+        if fields is not None and not any("." in field for field in fields):
+            projection = [f"data.{field}" for field in fields]
+
+        rows = (
+            DatasourceRow.objects(__raw__=self.row_query())
+            .only(*projection)
+            .order_by("index")
+            .as_pymongo()
+            .batch_size(DATASOURCE_BATCH_SIZE)
+        )
+        for row in rows:
+            yield row.get("data", {})
+
+    def to_dataset(self, fields=None, snapshot=None):
+        """ Load the data into a columnar Dataset, optionally restricted to the
+            given fields. The data is read from the given snapshot, or otherwise
+            the current snapshot (falling back to the rows of the current
+            version if the datasource has no snapshot yet). """
+
+        snapshot = snapshot or self.snapshot
+        if not snapshot:
+            return Dataset.from_rows(
+                self.iter_rows(fields), fields=fields, types=self.types
+            )
+
+        return Dataset.concat(
+            self.iter_snapshot(snapshot, fields), fields=fields, types=self.types
+        )
+
+    def iter_snapshot(self, snapshot, fields=None):
+        """ Lazily yield the chunks of the given snapshot as Datasets, only
+            decompressing the columns of the given fields """
+
+        chunks = (
+            DatasourceSnapshot.objects(__raw__=self.snapshot_query(snapshot))
+            .order_by("chunk")
+            .as_pymongo()
+            .batch_size(1)
+        )
+
+        for chunk in chunks:
+            yield Dataset(
+                [
+                    (field, Column(decompress_column(column)))
+                    for (field, column) in zip(chunk["fields"], chunk["columns"])
+                    if fields is None or field in fields
+                ],
+                chunk["rowCount"],
+            )
+
+    def snapshot_query(self, snapshot=None):
+        """ Query of the chunks of the given snapshot (by default the current
+            snapshot), which like the rows of a version may have been written by
+            an earlier snapshot, until the snapshot that they were removed in """
+
+        # Chunks written before chunks were shared (which have no chunk size)
+        # only belong to the snapshot that wrote them
+        snapshot = snapshot or self.snapshot
+        return {
+            "datasource": self.id,
+            "$or": [
+                {"snapshot": snapshot, "chunkSize": None},
+                {
+                    "snapshot": {"$lte": snapshot},
+                    "chunkSize": {"$ne": None},
+                    "removedIn": {"$not": {"$lte": snapshot}},
+                },
+            ],
+        }
+
+    def create_snapshot(self, indices=None):
+        """ Store the current version of the data as a new snapshot, made up of
+            chunks of rows (by their index) in which each column is compressed
+            separately. If the indices of the rows which have changed since the
+            current snapshot are given, then only the chunks that contain them
+            are written, and the other chunks are shared with that snapshot. """
+
+        collection = DatasourceSnapshot._get_collection()
+        chunk_size = DATASOURCE_BATCH_SIZE
+
+        # Chunks can only be shared with a snapshot of chunks of the same size
+        if indices is not None and (
+            not self.snapshot
+            or collection.find_one(
+                {**self.snapshot_query(), "chunkSize": {"$ne": chunk_size}}
+            )
+        ):
+            indices = None
+
+        base_snapshot = self.snapshot
+        snapshot = (
+            Datasource.objects(id=self.id)
+            .modify(inc__latestSnapshot=1, new=True)
+            .latestSnapshot
+        )
+
+        rows = self.row_query()
+        replaced = self.snapshot_query(base_snapshot)
+        if indices is not None:
+            chunks = sorted({index // chunk_size for index in indices})
+            rows["$or"] = [
+                {"index": {"$gte": chunk * chunk_size, "$lt": (chunk + 1) * chunk_size}}
+                for chunk in chunks
+            ]
+            replaced["chunk"] = {"$in": chunks}
+
+        cursor = (
+            DatasourceRow._get_collection()
+            .find(rows, {"index": True, "data": True})
+            .sort("index", 1)
+            .batch_size(DATASOURCE_BATCH_SIZE)
+        )
+        chunk_rows = groupby(cursor, key=lambda row: row["index"] // chunk_size)
+        for (index, batch) in chunk_rows:
+            chunk = Dataset.from_rows(row["data"] for row in batch)
+            collection.insert_one(
+                {
+                    "datasource": self.id,
+                    "snapshot": snapshot,
+                    "chunk": index,
+                    "chunkSize": chunk_size,
+                    "rowCount": len(chunk),
+                    "fields": chunk.fields,
+                    "columns": [
+                        compress_column(chunk[field].values.tolist())
+                        for field in chunk.fields
+                    ],
+                    "created": datetime.utcnow(),
+                }
+            )
+
+        # As with the rows of the data, the chunks which were rewritten are
+        # removed in this snapshot, which is only swapped to if no other snapshot
+        # has been created from the current snapshot in the meantime (in which
+        # case it will have removed some of the same chunks)
+        replaced_count = collection.count_documents(replaced)
+        is_current = replaced_count == (
+            collection.update_many(
+                {"$and": [replaced, {"removedIn": None}]},
+                {"$set": {"removedIn": snapshot}},
+            ).modified_count
+        )
+        is_current = is_current and (
+            Datasource._get_collection()
+            .update_one(
+                {"_id": self.id, "snapshot": base_snapshot},
+                {"$set": {"snapshot": snapshot}},
+            )
+            .matched_count
+        )
+        if not is_current:
+            collection.delete_many({"datasource": self.id, "snapshot": snapshot})
+            collection.update_many(
+                {"datasource": self.id, "removedIn": snapshot},
+                {"$unset": {"removedIn": 1}},
+            )
+
+            # The snapshot that replaced the current one may predate this version
+            # of the data, hence a snapshot of the whole data is created instead
+            self.reload("snapshot", "latestSnapshot")
+            return self.create_snapshot()
+
+        retained = snapshot - DATASOURCE_SNAPSHOT_RETENTION
+        collection.delete_many(
+            {
+                "datasource": self.id,
+                "$or": [
+                    {"snapshot": {"$lte": retained}, "chunkSize": None},
+                    {"removedIn": {"$lte": retained}},
+                ],
+            }
+        )
+
+        self.reload("snapshot", "latestSnapshot")
+
+        return snapshot
+
+    def write_data(self, batches):
+        """ Write the given batches of rows (as yielded by the retrieve_* 
+            services) to a new version of the data, and then swap the 
+            datasource over to that version """
+
+        version = Datasource.objects(id=self.id).modify(
+            inc__latestVersion=1, new=True
+        ).latestVersion
+
+        # The rows are only keyed by the primary key (so that later refreshes can
+        # be compared against them) if every row has a unique value for it
+        keys = set()
+        is_keyed = bool(self.primaryKey)
+
+        count = 0
+        collection = DatasourceRow._get_collection()
+        for batch in batches:
+            if not len(batch):
+                continue
+
+            for row in batch if is_keyed else []:
+                key = row.get(self.primaryKey)
+                if key is None or key in keys:
+                    is_keyed = False
+                    keys = set()
+                    break
+                keys.add(key)
+
+            collection.insert_many(
+                [
+                    {
+                        "datasource": self.id,
+                        "version": version,
+                        "index": count + index,
+                        "key": row.get(self.primaryKey) if self.primaryKey else None,
+                        "hash": hash_row(row),
+                        "data": row,
+                    }
+                    for (index, row) in enumerate(batch)
+                ],
+                ordered=False,
+            )
+            count += len(batch)
+
+        # Only swap to this version if a newer one hasn't been written in the
+        # meantime. The inline data of legacy documents is removed at this point.
+        is_latest = Datasource._get_collection().update_one(
+            {"_id": self.id, "version": {"$not": {"$gte": version}}},
+            {
+                "$set": {
+                    "version": version,
+                    "rowCount": count,
+                    "keyedBy": self.primaryKey if is_keyed else None,
+                },
+                "$unset": {"data": 1},
+            },
+        ).matched_count
+
+        # Every row of this version was written by it, so the rows of earlier
+        # versions can be removed (unless a newer version has been written, which
+        # may still include rows of earlier versions)
+        if is_latest:
+            DatasourceRow.objects(datasource=self.id, version__lt=version).delete()
+        else:
+            DatasourceRow.objects(datasource=self.id, version=version).delete()
+
+        self.reload("version", "latestVersion", "rowCount", "keyedBy")
+        self.create_snapshot()
 
-    def retrieve_data(self, connection=None, file=None):
+        return count
+
+    def write_data_delta(self, batches):
+        """ Compare the given batches of rows against the current version of the
+            data by their primary key, and write a new version of the data which
+            only writes the rows that have been inserted or updated (and removes
+            the rows that have been updated or deleted), and then swap the
+            datasource over to that version. Returns the primary keys of the
+            changed rows, or None if the rows couldn't be compared by primary
+            key (as it is missing or not unique), in which case the data has
+            instead been written in full. """
+
+        base_version = self.version
+        collection = DatasourceRow._get_collection()
+
+        # Fingerprints and positions of the rows currently stored, by primary key
+        stored_rows = {}
+        next_index = 0
+        for row in collection.find(
+            self.row_query(), {"key": True, "hash": True, "index": True}
+        ).batch_size(DATASOURCE_BATCH_SIZE):
+            key = row.get("key")
+            if key is None or key in stored_rows:
+                self.write_data(batches)
+                return None
+            stored_rows[key] = (row["_id"], row.get("hash"), row["index"])
+            next_index = max(next_index, row["index"] + 1)
+
+        version = Datasource.objects(id=self.id).modify(
+            inc__latestVersion=1, new=True
+        ).latestVersion
+
+        changes = {"inserted": [], "updated": [], "deleted": []}
+        changed_indices = []
+        seen_keys = set()
+        removed_ids = []
+        # The id of the row of this version for each of the rows compared so far
+        row_ids = []
+        inserts = []
+
+        batches = iter(batches)
+        for batch in batches:
+            for (position, row) in enumerate(batch):
+                key = row.get(self.primaryKey)
+                if key is None or key in seen_keys:
+                    # Write the rows compared so far (as read back from their
+                    # rows) along with the remaining rows in full instead
+                    if inserts:
+                        collection.insert_many(inserts, ordered=False)
+                    compared_rows = self.iter_rows_by_id(row_ids)
+                    self.write_data(chain(compared_rows, [batch[position:]], batches))
+                    collection.delete_many({"datasource": self.id, "version": version})
+                    return None
+                seen_keys.add(key)
+
+                row_hash = hash_row(row)
+                stored_row = stored_rows.get(key)
+                if stored_row is not None and stored_row[1] == row_hash:
+                    row_ids.append(stored_row[0])
+                    continue
+
+                # Updated rows are replaced by a row of this version, in place
+                if stored_row is None:
+                    index = next_index
+                    next_index += 1
+                    changes["inserted"].append(key)
+                else:
+                    index = stored_row[2]
+                    removed_ids.append(stored_row[0])
+                    changes["updated"].append(key)
+
+                changed_indices.append(index)
+                row_id = ObjectId()
+                row_ids.append(row_id)
+                inserts.append(
+                    {
+                        "_id": row_id,
+                        "datasource": self.id,
+                        "version": version,
+                        "index": index,
+                        "key": key,
+                        "hash": row_hash,
+                        "data": row,
+                    }
+                )
+                if len(inserts) == DATASOURCE_BATCH_SIZE:
+                    collection.insert_many(inserts, ordered=False)
+                    inserts = []
+
+        if inserts:
+            collection.insert_many(inserts, ordered=False)
+
+        for key, (row_id, _, index) in stored_rows.items():
+            if key not in seen_keys:
+                removed_ids.append(row_id)
+                changed_indices.append(index)
+                changes["deleted"].append(key)
+
+        # Rows can only be removed by one version, so if any of them have already
+        # been removed then another refresh has written the data in the meantime
+        is_current = True
+        for ids in batch_rows(removed_ids):
+            result = collection.update_many(
+                {"_id": {"$in": ids}, "removedIn": None},
+                {"$set": {"removedIn": version}},
+            )
+            is_current = is_current and result.modified_count == len(ids)
+
+        # Only swap to this version if the data is still at the version that the
+        # rows were compared against
+        is_current = (
+            is_current
+            and Datasource._get_collection()
+            .update_one(
+                {"_id": self.id, "version": base_version},
+                {"$set": {"version": version, "rowCount": len(seen_keys)}},
+            )
+            .matched_count
+        )
+        if not is_current:
+            collection.delete_many({"datasource": self.id, "version": version})
+            collection.update_many(
+                {"datasource": self.id, "removedIn": version},
+                {"$unset": {"removedIn": 1}},
+            )
+            raise Exception("The data was written by another refresh in the meantime")
+
+        # The removed rows are no longer part of the current version
+        collection.delete_many({"datasource": self.id, "removedIn": {"$lte": version}})
+
+        # Only the chunks of the snapshot which contain the changed rows are written
+        self.reload("version", "rowCount")
+        if changed_indices:
+            self.create_snapshot(changed_indices)
+
+        return changes
+
+    def iter_rows_by_id(self, row_ids):
+        """ Lazily yield batches of the rows with the given ids, in order """
+
+        collection = DatasourceRow._get_collection()
+        for ids in batch_rows(row_ids):
+            rows = collection.find({"_id": {"$in": ids}}, {"data": True})
+            data = {row["_id"]: row["data"] for row in rows}
+            yield [data[row_id] for row_id in ids]
+
+    def retrieve_data(self, connection=None, file=None, s3_object=None):
         if not connection:
             connection = self.connection
 
+        # Batches of rows
         data = []
 
         if self.connection.dbType in ["mysql", "postgresql", "sqlite", "mssql"]:
             data = retrieve_sql_data(connection)
 
         elif self.connection.dbType == "s3BucketFile":
-            data = retrieve_file_from_s3(connection)
+            data = retrieve_file_from_s3(connection, s3_object)
 
         elif self.connection.dbType == "xlsXlsxFile":
             sheetname = connection.get("sheetname")
@@ -95,6 +560,13 @@ class Datasource(Document):
         return data
 
     def refresh_data(self):
+        """ Re-import the data from the datasource's connection. Returns the 
+            changes made to the data, or False if the data did not need to be 
+            refreshed because it hasn't changed. If the datasource has a primary
+            key, then the changes include the primary keys of the rows that were
+            inserted, updated and deleted. Otherwise the data is replaced in 
+            full, which is denoted by "full" in the changes. """
+
         if self.connection.dbType in [
             "s3BucketFile",
             "mysql",
@@ -102,5 +574,105 @@ class Datasource(Document):
             "sqlite",
             "mssql",
         ]:
-            self.data = self.retrieve_data()
+            s3_object = None
+            if self.connection.dbType == "s3BucketFile":
+                # Skip the download, parse and write entirely if the file has not
+                # changed since it was last retrieved
+                s3_object = get_s3_object(self.connection, etag=self.etag)
+                if s3_object is None:
+                    return False
+
+            first_batch, data = peek_batches(self.retrieve_data(s3_object=s3_object))
+            if not len(first_batch):
+                raise Exception("No data was returned from the datasource")
+
+            inference = ColumnTypeInference()
+            data = inference.observe(data)
+
+            # The stored rows can only be compared by primary key if they were
+            # keyed by the current primary key when written (which is not the
+            # case if the primary key has since been set or changed, or if it
+            # wasn't unique), and otherwise the data is written in full
+            changes = None
+            if self.primaryKey and self.version and self.keyedBy == self.primaryKey:
+                changes = self.write_data_delta(data)
+            else:
+                self.write_data(data)
+
+            if changes is None:
+                changes = {"full": True, "inserted": [], "updated": [], "deleted": []}
+            else:
+                changes["full"] = False
+
+            self.lastChanges = {
+                "full": changes["full"],
+                "inserted": len(changes["inserted"]),
+                "updated": len(changes["updated"]),
+                "deleted": len(changes["deleted"]),
+            }
+            self.fields = list(first_batch[0].keys())
+            self.types = inference.types()
+            self.columnStats = inference.stats()
+            if changes["full"] or any(self.lastChanges.values()):
+                self.lastUpdated = datetime.utcnow()
+
+            if s3_object is not None:
+                self.etag = s3_object["ETag"]
+                self.fileSize = s3_object["ContentLength"]
+
             self.save()
+
+            return changes
+
+        return False
+
+
+class DatasourceRow(Document):
+    # Cascade delete if datasource is deleted
+    datasource = ReferenceField(Datasource, required=True, reverse_delete_rule=2)
+    version = IntField(required=True)
+    # Position of the row in the data, to preserve the order of the source
+    index = IntField(required=True)
+    # The version in which the row was removed (i.e. deleted or replaced by an
+    # updated row), if it was removed by an incremental refresh
+    removedIn = IntField(null=True)
+    # Value of the primary key of the datasource (if it has one) for this row
+    key = BaseField(null=True)
+    # Fingerprint of the row's values, to detect changes on incremental refreshes
+    hash = StringField()
+    data = DictField()
+
+    meta = {
+        "indexes": [
+            ("datasource", "index", "version"),
+            ("datasource", "version", "key"),
+            ("datasource", "removedIn"),
+        ]
+    }
+
+
+class DatasourceSnapshot(Document):
+    # A chunk of rows of a snapshot of a datasource's data
+    # Cascade delete if datasource is deleted
+    datasource = ReferenceField(Datasource, required=True, reverse_delete_rule=2)
+    snapshot = IntField(required=True)
+    # Position of the chunk in the snapshot, i.e. the chunk of the rows whose
+    # index is in the range [chunk * chunkSize, (chunk + 1) * chunkSize)
+    chunk = IntField(required=True)
+    chunkSize = IntField(null=True)
+    # A chunk is also part of later snapshots, until the snapshot that rewrote it
+    removedIn = IntField(null=True)
+    rowCount = IntField()
+    fields = ListField(StringField())
+    # The values of each of the fields (in the same order as the fields),
+    # stored as zlib-compressed BSON
+    columns = ListField(BinaryField())
+    created = DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        "indexes": [
+            ("datasource", "snapshot", "chunk"),
+            ("datasource", "chunk", "snapshot"),
+            ("datasource", "removedIn"),
+        ]
+    }
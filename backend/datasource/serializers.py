@@ -1,9 +1,28 @@
-from rest_framework_mongoengine import serializers
+from rest_framework import serializers
+from rest_framework_mongoengine.serializers import DocumentSerializer
 
 from .models import Datasource
 
 
-class DatasourceSerializer(serializers.DocumentSerializer):
+class DatasourceSerializer(DocumentSerializer):
+    # The rows of the datasource are stored outside of the datasource document
+    data = serializers.SerializerMethodField()
+
+    def get_data(self, datasource):
+        return list(datasource.iter_rows())
+
     class Meta:
         model = Datasource
         fields = '__all__'
+        read_only_fields = [
+            "version",
+            "latestVersion",
+            "rowCount",
+            "etag",
+            "fileSize",
+            "lastChanges",
+            "columnStats",
+            "keyedBy",
+            "snapshot",
+            "latestSnapshot",
+        ]
@@ -1,24 +1,175 @@
 from cryptography.fernet import Fernet
+from botocore.exceptions import ClientError
 from sqlalchemy import create_engine
 from sqlalchemy.engine.url import URL
 from xlrd import open_workbook
+from openpyxl import load_workbook
+from openpyxl.utils.datetime import to_excel
+from xml.etree import ElementTree
+from tempfile import SpooledTemporaryFile
+from datetime import datetime, date, time as dt_time
 import csv
 import boto3
-import io
-import random
+import codecs
+import hashlib
+import json
+import re
 import os
-from collections import defaultdict
+import threading
+import time
+import zipfile
+import zlib
+import numpy as np
+from collections import Counter, OrderedDict
+from itertools import chain, islice
 from dateutil import parser
+from bson import BSON
+
+from .dataset import MISSING, object_array
 
 from ontask.settings import (
     SECRET_KEY,
     DB_DRIVER_MAPPING,
-    SMTP
+    SMTP,
+    DATASOURCE_BATCH_SIZE,
+    SQL_ENGINE_POOL,
 )
 
 
-def retrieve_sql_data(connection):
-    """Generic service to retrieve data from an SQL server with a provided query"""
+# Number of bytes read from an uploaded (or s3) file at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+# Number of bytes of a spooled file that are kept in memory before it is moved
+# to disk (see spool_file)
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+
+def batch_rows(rows, batch_size=DATASOURCE_BATCH_SIZE):
+    """ Group an iterable of rows into lists of at most batch_size rows, 
+        without materialising the whole iterable """
+
+    rows = iter(rows)
+    batch = list(islice(rows, batch_size))
+    while batch:
+        yield batch
+        batch = list(islice(rows, batch_size))
+
+
+def compress_column(values):
+    """ Compress the values of a column (which may include missing values) into
+        zlib-compressed BSON, for storage in a snapshot """
+
+    missing = [index for (index, value) in enumerate(values) if value is MISSING]
+    if missing:
+        values = [None if value is MISSING else value for value in values]
+
+    return zlib.compress(BSON.encode({"values": values, "missing": missing}))
+
+
+def decompress_column(column):
+    column = BSON(zlib.decompress(column)).decode()
+    values = column["values"]
+    for index in column["missing"]:
+        values[index] = MISSING
+
+    return values
+
+
+def peek_batches(batches):
+    """ Read the first batch of rows ahead of time, returning it along with an
+        iterator over all of the batches (including the first) """
+
+    batches = iter(batches)
+    first_batch = next(batches, [])
+    return first_batch, chain([first_batch], batches)
+
+
+def hash_row(row):
+    """ Fingerprint of the values of a row, used to detect which rows have 
+        changed between refreshes of a datasource """
+
+    return hashlib.md5(
+        json.dumps(row, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def iter_lines(file, encoding="utf-8"):
+    """ Incrementally read and decode a binary file, yielding one line at a 
+        time (including the line break) """
+
+    decoder = codecs.getincrementaldecoder(encoding)()
+    remainder = ""
+
+    for chunk in iter(lambda: file.read(READ_CHUNK_SIZE), b""):
+        lines = (remainder + decoder.decode(chunk)).splitlines(keepends=True)
+        # The last line may be incomplete (or be a "\r" whose "\n" is yet to be
+        # read), so hold it back until the next chunk has been read
+        remainder = lines.pop() if lines else ""
+        yield from lines
+
+    remainder += decoder.decode(b"", final=True)
+    if remainder:
+        yield from remainder.splitlines(keepends=True)
+
+
+# Process-wide registry of SQLAlchemy engines (each with its own connection pool)
+# for the external databases, keyed by the connection parameters
+engines = OrderedDict()
+engines_lock = threading.Lock()
+engines_pid = os.getpid()
+
+
+def get_engine(connection_parameters):
+    """ Retrieve the pooled engine for the given connection parameters, creating
+        it if necessary. Engines that have been idle for longer than the idle 
+        timeout (or that exceed the maximum number of engines) are disposed. """
+
+    global engines_pid
+
+    key = tuple(sorted(connection_parameters.items()))
+    now = time.monotonic()
+
+    with engines_lock:
+        # Pooled connections must not be shared with a forked process (e.g. a
+        # uWSGI or Celery worker), so start with a fresh registry in the child
+        if engines_pid != os.getpid():
+            engines.clear()
+            engines_pid = os.getpid()
+
+        if key in engines:
+            engine, _ = engines.pop(key)
+        else:
+            engine = create_engine(
+                URL(**connection_parameters),
+                pool_size=SQL_ENGINE_POOL["POOL_SIZE"],
+                max_overflow=SQL_ENGINE_POOL["MAX_OVERFLOW"],
+                pool_recycle=SQL_ENGINE_POOL["POOL_RECYCLE"],
+                # Test connections for liveness before they are checked out
+                pool_pre_ping=True,
+            )
+
+        # Evict engines which have been idle for too long, along with the least
+        # recently used engines if the registry is over capacity
+        for idle_key, (idle_engine, last_used) in list(engines.items()):
+            if (
+                now - last_used > SQL_ENGINE_POOL["IDLE_TIMEOUT"]
+                or len(engines) >= SQL_ENGINE_POOL["MAX_ENGINES"]
+            ):
+                engines.pop(idle_key)
+                idle_engine.dispose()
+
+        # The most recently used engine is kept at the end of the registry
+        engines[key] = (engine, now)
+
+    return engine
+
+
+def fetch_sql_data(connection, batch_size=DATASOURCE_BATCH_SIZE):
+    """ Generic service to retrieve data from an SQL server with a provided 
+        query. The results are fetched from a server-side cursor in batches of 
+        batch_size rows, with each batch yielded as a tuple of (fields, rows). 
+        The list of fields is shared by every batch, and each row is a tuple of
+        values in the same order as the fields. """
 
     # Decrypt the password provided by the user to connect to the remote database
     cipher = Fernet(SECRET_KEY)
@@ -40,62 +191,145 @@ def retrieve_sql_data(connection):
     }
 
     # SQL alchemy code to add connect to the external DB generically to access the query data
-    engine = create_engine(URL(**connection_parameters))
+    # The connection is checked out of (and returned to) the engine's pool
+    engine = get_engine(connection_parameters)
     db_connection = engine.connect()
 
-    # Stream the results from the user query
-    # The stream_results=True argument here will eliminate the buffering of the query results
-    # The result rows are not buffered, but fetched as they're needed.
-    # Ref - http://dev.mobify.com/blog/sqlalchemy-memory-magic/
     try:
-        results = db_connection.execution_options(stream_results=True).execute(
-            connection["query"]
-        )
-    except:
-        raise Exception("Query returned an error")
+        # Stream the results from the user query
+        # The stream_results=True argument here will eliminate the buffering of the query results
+        # The result rows are not buffered, but fetched as they're needed.
+        # Ref - http://dev.mobify.com/blog/sqlalchemy-memory-magic/
+        try:
+            results = db_connection.execution_options(stream_results=True).execute(
+                connection["query"]
+            )
+        except:
+            raise Exception("Query returned an error")
+
+        # Identify the columns of the results once, rather than for every row
+        fields = list(results.keys())
+
+        rows = results.fetchmany(batch_size)
+        while rows:
+            yield fields, [tuple(row) for row in rows]
+            rows = results.fetchmany(batch_size)
 
-    # Convert the buffered results into a list of dicts
-    data = [dict(zip(row.keys(), row)) for row in results]
+    finally:
+        db_connection.close()
 
-    db_connection.close()
 
-    return data
+def retrieve_sql_data(connection, batch_size=DATASOURCE_BATCH_SIZE):
+    """ Generic service to retrieve data from an SQL server with a provided 
+        query, yielding the rows in batches of dicts """
+
+    for fields, rows in fetch_sql_data(connection, batch_size):
+        yield [dict(zip(fields, row)) for row in rows]
 
 
 def retrieve_csv_data(file, delimiter):
     """ Generic service to retrieve data from a csv file with a given 
-        delimiter (comma by default) """
+        delimiter (comma by default). The file is read incrementally, and the
+        rows are yielded in batches, so that the whole file is never held in 
+        memory at once """
 
     delimiter = "," if delimiter is None else delimiter
 
-    file = file.read().decode("utf-8").splitlines()
-    column_headers = file.pop(0).split(delimiter)
+    lines = iter_lines(file)
+
+    header = next(lines, "").splitlines()
+    column_headers = (header[0] if header else "").split(delimiter)
     for (index, header) in enumerate(column_headers):
         for char in [".", "$", '"', "'"]:
             if char in header:
                 column_headers[index] = column_headers[index].replace(char, "")
 
-    file = "\r\n".join(file)
-    reader = csv.DictReader(
-        io.StringIO(file), fieldnames=column_headers, delimiter=delimiter
-    )
-    data = list(reader)
+    reader = csv.DictReader(lines, fieldnames=column_headers, delimiter=delimiter)
 
-    return data
+    yield from batch_rows(reader)
+
+
+def spool_file(file):
+    """ Ensure that the given file is seekable, which is required in order to 
+        read Excel files. Streams that cannot seek (e.g. the body of an s3 
+        object) are spooled to a temporary file, which only stays in memory up
+        to SPOOL_MAX_SIZE bytes. """
+
+    try:
+        file.seek(0)
+        return file
+    except (AttributeError, OSError):
+        spooled_file = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        for chunk in iter(lambda: file.read(READ_CHUNK_SIZE), b""):
+            spooled_file.write(chunk)
+        spooled_file.seek(0)
+        return spooled_file
+
+
+def is_xlsx(file):
+    """ .xlsx workbooks are zip archives, whereas .xls workbooks are not """
+
+    is_zip = zipfile.is_zipfile(file)
+    file.seek(0)
+    return is_zip
+
+
+def iter_xls_rows(file, sheetname):
+    """ Yield the row values of the given sheet of an .xls workbook. Only the 
+        chosen sheet is parsed, and each row is read in bulk. """
+
+    book = open_workbook(file_contents=file.read(), on_demand=True)
+    try:
+        sheet = book.sheet_by_name(sheetname)
+        for x in range(sheet.nrows):
+            yield sheet.row_values(x)
+    finally:
+        book.release_resources()
+
+
+def iter_xlsx_rows(file, sheetname):
+    """ Yield the row values of the given sheet of an .xlsx workbook, using the 
+        read-only mode of openpyxl to stream the rows of the sheet rather than
+        loading the whole workbook into memory """
+
+    book = load_workbook(file, read_only=True, data_only=True)
+    try:
+        for row in book[sheetname].iter_rows():
+            values = []
+            for cell in row:
+                value = cell.value
+                # Store the values as xlrd reads them (as was previously the case
+                # for .xlsx workbooks, and still is for .xls), i.e. empty cells as
+                # empty strings, numbers as floats, booleans as integers and dates
+                # as the serial number of the date in the workbook's calendar
+                if value is None:
+                    value = ""
+                elif isinstance(value, bool):
+                    value = int(value)
+                elif isinstance(value, int):
+                    value = float(value)
+                elif isinstance(value, (datetime, date, dt_time)):
+                    value = to_excel(value, book.excel_base_date)
+                values.append(value)
+            yield values
+    finally:
+        book.close()
 
 
 def retrieve_excel_data(file, sheetname):
     """ Generic service to retrieve data from the given sheetname of an 
-        excel file (supports both .xls and .xlsx) """
+        excel file (supports both .xls and .xlsx). The rows are yielded in 
+        batches. """
 
-    book = open_workbook(file_contents=file.read())
-    sheet = book.sheet_by_name(sheetname)
-
-    number_of_columns = sheet.ncols
-    number_of_rows = sheet.nrows
+    file = spool_file(file)
+    if is_xlsx(file):
+        rows = iter_xlsx_rows(file, sheetname)
+    else:
+        rows = iter_xls_rows(file, sheetname)
 
     # Identify the header of each column
-    fields = [sheet.cell(0, y).value for y in range(number_of_columns)]
+    fields = [str(field) for field in next(rows, [])]
+    number_of_columns = len(fields)
 
     # Remove illegal characters from column headers
     for index, field in enumerate(fields):
@@ -103,82 +337,217 @@ def retrieve_excel_data(file, sheetname):
             if char in field:
                 fields[index] = fields[index].replace(char, "")
 
-    # Initialize the list that will store the dicts which represent each row
-    data = []
+    # Iterate over the rows, skipping the first (i.e. the headers). Rows which
+    # are shorter than the header are padded with empty values
+    padding = [""] * number_of_columns
+    yield from batch_rows(
+        dict(zip(fields, list(row[:number_of_columns]) + padding[len(row) :]))
+        for row in rows
+    )
 
-    # Iterate over the rows, skipping the first (i.e. the headers)
-    for x in range(1, number_of_rows):
-        data.append(
-            {fields[y]: sheet.cell(x, y).value for y in range(number_of_columns)}
-        )
 
-    return data
+def retrieve_excel_sheetnames(file):
+    """ Generic service to retrieve the sheetnames of an excel file (supports 
+        both .xls and .xlsx), reading only the metadata of the workbook """
 
+    file = spool_file(file)
 
-def retrieve_file_from_s3(connection):
-    """ Generic service to retrieve the data from a file in an s3 bucket, 
-        depending on the type of the file """
+    if not is_xlsx(file):
+        book = open_workbook(file_contents=file.read(), on_demand=True)
+        sheetnames = book.sheet_names()
+        book.release_resources()
+        return sheetnames
+
+    # The sheetnames of an .xlsx workbook are listed in its workbook.xml part
+    with zipfile.ZipFile(file) as archive:
+        workbook = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+
+    return [
+        element.get("name")
+        for element in workbook.iter()
+        if element.tag.rsplit("}", 1)[-1] == "sheet"
+    ]
+
+
+def get_s3_object(connection, etag=None):
+    """ Generic service to retrieve an object from an s3 bucket. If the ETag of
+        a previously retrieved version of the object is provided, then the 
+        object is only retrieved if it has changed since (otherwise None is 
+        returned). The body of the object is not downloaded until it is read. """
 
     try:
         bucket = connection["bucket"]
         file_name = connection["fileName"]
-        delimiter = connection["delimiter"] if "delimiter" in connection else None
-        sheetname = connection["sheetname"] if "sheetname" in connection else None
     except:
         raise Exception("Invalid connection settings")
 
     try:
         s3 = boto3.resource("s3")
         obj = s3.Object(bucket, file_name)
-        file = obj.get()["Body"]
+
+        # Conditional GET, which responds with 304 Not Modified if the ETag matches
+        if etag:
+            return obj.get(IfNoneMatch=etag)
+
+        return obj.get()
+    except ClientError as error:
+        error_code = error.response.get("Error", {}).get("Code")
+        if etag and error_code in ["304", "NotModified"]:
+            return None
+        raise Exception("Error reading file from s3 bucket")
+    except:
+        raise Exception("Error reading file from s3 bucket")
+
+
+def retrieve_file_from_s3(connection, s3_object=None):
+    """ Generic service to retrieve the data from a file in an s3 bucket, 
+        depending on the type of the file. The body of the object is streamed
+        rather than downloaded up front. The object can be provided if it has
+        already been retrieved via get_s3_object. """
+
+    try:
+        file_name = connection["fileName"]
+        delimiter = connection["delimiter"] if "delimiter" in connection else None
+        sheetname = connection["sheetname"] if "sheetname" in connection else None
+    except:
+        raise Exception("Invalid connection settings")
+
+    if s3_object is None:
+        s3_object = get_s3_object(connection)
+
+    try:
+        file = s3_object["Body"]
 
         # Parse the data based on the file type
         if file_name.lower().endswith((".csv", ".txt")):
-            return retrieve_csv_data(file, delimiter)
+            yield from retrieve_csv_data(file, delimiter)
         elif file_name.lower().endswith((".xls", ".xlsx")):
-            return retrieve_excel_data(file, sheetname)
+            yield from retrieve_excel_data(file, sheetname)
         else:
             raise Exception("File type is not supported")
-    except:
+    # Exception rather than a bare except, so that closing the generator early
+    # (which raises GeneratorExit within it) is not treated as an error
+    except Exception:
         raise Exception("Error reading file from s3 bucket")
 
 
-def guess_column_types(data):
-    # Take 25 random records from the dataset, or the entire dataset if
-    # there are less than 25 records
-    data_range = range(len(data))
-    chosen_indexes = random.sample(data_range, 25) if len(data) > 25 else data_range
-
-    # Create a set of values for each field across the chosen indexes
-    records = defaultdict(set)
-    for i in chosen_indexes:
-        for field, value in data[i].items():
-            records[field].add(value)
-
-    types = {}
-    for field, values in records.items():
-        for value in values:
-            # If one of the records has been determined to be text, then
-            # skip further type checking. Following this approach, a column
-            # will only be given a type of 'number' or 'date' if *all* records
-            # conform to that type.
-            if field in types and types[field] == "text":
-                break
+# Dates in ISO 8601 format, which are recognised without the need for dateutil
+ISO_DATE_PATTERN = re.compile(
+    r"^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}:?\d{2})?$"
+)
+
+
+class ColumnTypeInference:
+    """ Infers the type (number, date or text) of each column from every value in
+        the column, as the batches of rows stream past on their way to being
+        written (see observe). Following the approach of the original sampling,
+        a column is only given a type of number or date if *all* of its values
+        conform to that type, although null and empty values are now ignored. """
+
+    def __init__(self):
+        self.rows = 0
+        # Number of values of each kind in each column
+        self.counts = OrderedDict()
+
+    def observe(self, batches):
+        """ Pass the batches through unchanged, updating the inference with each """
+
+        for batch in batches:
+            self.update(batch)
+            yield batch
+
+    def update(self, batch):
+        columns = OrderedDict()
+        for row in batch:
+            for field, value in row.items():
+                if field not in columns:
+                    columns[field] = []
+                columns[field].append(value)
+
+        for field, values in columns.items():
+            if field not in self.counts:
+                self.counts[field] = {"number": 0, "date": 0, "text": 0}
+            self.update_column(self.counts[field], values)
 
+        self.rows += len(batch)
+
+    def update_column(self, counts, values):
+        # Fast path for columns in which every value is (or can be cast to) a number
+        if None not in values:
             try:
-                float(value)
-                types[field] = "number"
-                continue
-            except:
+                object_array(values).astype(np.float64)
+                counts["number"] += len(values)
+                return
+            except (ValueError, TypeError):
                 pass
 
+        # Otherwise classify each distinct value once
+        try:
+            distinct = Counter(values).items()
+        except TypeError:
+            # Unhashable values (e.g. lists)
+            distinct = [(value, 1) for value in values]
+
+        for value, count in distinct:
+            kind = self.classify(counts, value)
+            if kind is not None:
+                counts[kind] += count
+
+    def classify(self, counts, value):
+        if value is None or isinstance(value, str) and not value.strip():
+            return None
+
+        if isinstance(value, (datetime, date)):
+            return "date"
+
+        try:
+            float(value)
+            return "number"
+        except (ValueError, TypeError):
+            pass
+
+        if not isinstance(value, str):
+            return "text"
+
+        if ISO_DATE_PATTERN.match(value.strip()):
+            return "date"
+
+        # Only fall back to dateutil (which is comparatively slow) while the
+        # column could still be given a type of date
+        if not counts["number"] and not counts["text"]:
             try:
-                test = parser.parse(value)
-                types[field] = "date"
-                continue
-            except:
+                parser.parse(value)
+                return "date"
+            except (ValueError, OverflowError):
                 pass
 
-            types[field] = "text"
+        return "text"
 
-    return types
+    def types(self):
+        types = {}
+        for field, counts in self.counts.items():
+            non_null = sum(counts.values())
+            if non_null and counts["number"] == non_null:
+                types[field] = "number"
+            elif non_null and counts["date"] == non_null:
+                types[field] = "date"
+            else:
+                types[field] = "text"
+        return types
+
+    def stats(self):
+        """ The confidence of each column's type (i.e. the proportion of non-null
+            values which conform to it) and the proportion of null values """
+
+        stats = {}
+        for field, field_type in self.types().items():
+            counts = self.counts[field]
+            non_null = sum(counts.values())
+            stats[field] = {
+                "type": field_type,
+                "confidence": round(counts[field_type] / non_null, 4)
+                if non_null
+                else 0,
+                "nullRatio": round(1 - non_null / self.rows, 4) if self.rows else 0,
+            }
+        return stats
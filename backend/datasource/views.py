@@ -7,7 +7,6 @@ from rest_framework.response import Response
 
 import json
 import boto3
-from xlrd import open_workbook
 from datetime import datetime
 import os
 
@@ -21,12 +20,16 @@ from .permissions import DatasourcePermissions
 from container.models import Container
 
 from .utils import (
+    ColumnTypeInference,
+    peek_batches,
     retrieve_csv_data,
     retrieve_excel_data,
+    retrieve_excel_sheetnames,
+    get_s3_object,
     retrieve_file_from_s3,
     retrieve_sql_data,
-    guess_column_types,
 )
+from scheduler.tasks import refresh_dependent_datalabs
 from scheduler.methods import (
     create_scheduled_task,
     remove_scheduled_task,
@@ -66,6 +69,9 @@ class DatasourceViewSet(viewsets.ModelViewSet):
 
         # If the datasource includes a file, then the payload will be a flat FormData object
         # In this case, the JSON payload was stringified, and must be parsed into a JSON object
+        # The ETag and size of the file, if the data is from an s3 bucket
+        s3_metadata = {"etag": None, "fileSize": None}
+
         if "file" in self.request.data:
             connection = json.loads(self.request.data["payload"])["connection"]
             file = self.request.data["file"]
@@ -80,7 +86,12 @@ class DatasourceViewSet(viewsets.ModelViewSet):
             connection = self.request.data["connection"]
 
             if connection["dbType"] == "s3BucketFile":
-                data = retrieve_file_from_s3(connection)
+                s3_object = get_s3_object(connection)
+                s3_metadata = {
+                    "etag": s3_object["ETag"],
+                    "fileSize": s3_object["ContentLength"],
+                }
+                data = retrieve_file_from_s3(connection, s3_object)
 
             else:
                 cipher = Fernet(SECRET_KEY)
@@ -89,18 +100,35 @@ class DatasourceViewSet(viewsets.ModelViewSet):
                 )
                 data = retrieve_sql_data(connection)
 
-        if not len(data):
+        # The data is streamed in batches, so read the first batch before saving
+        # the datasource in order to surface any connection errors early
+        first_batch, data = peek_batches(data)
+
+        if not len(first_batch):
             raise ValidationError("No data was returned from the datasource")
 
         # Identify the field names from the keys of the first row of the data
         # This is sufficient, as we can assume that all rows have the same keys
-        fields = list(data[0].keys())
-        types = guess_column_types(data)
+        fields = list(first_batch[0].keys())
 
         datasource = serializer.save(
-            connection=connection, data=data, fields=fields, types=types
+            connection=connection, fields=fields, **s3_metadata
         )
 
+        # The types of the fields are inferred from every row as it is written
+        inference = ColumnTypeInference()
+
+        try:
+            datasource.write_data(inference.observe(data))
+        except:
+            # Don't leave an empty datasource behind if the data failed to be read
+            datasource.delete()
+            raise
+
+        datasource.types = inference.types()
+        datasource.columnStats = inference.stats()
+        datasource.save()
+
         audit = AuditSerializer(
             data={
                 "model": "datasource",
@@ -126,6 +154,7 @@ class DatasourceViewSet(viewsets.ModelViewSet):
             raise ValidationError("A datasource with this name already exists")
 
         data = None
+        s3_metadata = {"etag": None, "fileSize": None}
 
         # If the datasource includes a file, then the payload will be a flat FormData object
         # In this case, the JSON payload was stringified, and must be parsed into a JSON object
@@ -155,7 +184,12 @@ class DatasourceViewSet(viewsets.ModelViewSet):
                 ):
                     connection["delimiter"] = datasource["connection"]["delimiter"]
 
-                data = retrieve_file_from_s3(connection)
+                s3_object = get_s3_object(connection)
+                s3_metadata = {
+                    "etag": s3_object["ETag"],
+                    "fileSize": s3_object["ContentLength"],
+                }
+                data = retrieve_file_from_s3(connection, s3_object)
 
             elif connection["dbType"] in ["mysql", "postgresql"]:
                 if "password" in connection:
@@ -173,19 +207,36 @@ class DatasourceViewSet(viewsets.ModelViewSet):
 
                 data = retrieve_sql_data(connection)
 
-        if data:
+        first_batch = []
+        if data is not None:
+            first_batch, data = peek_batches(data)
+
+        if len(first_batch):
             # Identify the field names from the keys of the first row of the data
             # This is sufficient, as we can assume that all rows have the same keys
-            fields = list(data[0].keys())
-            types = guess_column_types(data)
+            fields = list(first_batch[0].keys())
+
+            # Write the data before saving the datasource, so that the datasource
+            # is left untouched if the data fails to be read part way through.
+            # The types of the fields are inferred from every row as it is written.
+            # The rows are keyed by the primary key being saved (if any)
+            datasource.primaryKey = serializer.validated_data.get(
+                "primaryKey", datasource.primaryKey
+            )
+            inference = ColumnTypeInference()
+            datasource.write_data(inference.observe(data))
 
             serializer.save(
                 connection=connection,
-                data=data,
                 fields=fields,
-                types=types,
+                types=inference.types(),
+                columnStats=inference.stats(),
                 lastUpdated=datetime.utcnow(),
+                **s3_metadata,
             )
+
+            # Rebuild the data of the DataLabs that use this datasource
+            refresh_dependent_datalabs(datasource.id)
         else:
             serializer.save(connection=connection)
 
@@ -364,13 +415,16 @@ class DatasourceViewSet(viewsets.ModelViewSet):
         matching_field = self.request.data["matchingField"]
         matching_datasource = Datasource.objects.get(id=matching_field["datasource"])
         matching_fields = set(
-            [record[matching_field["field"]] for record in matching_datasource["data"]]
+            [
+                record[matching_field["field"]]
+                for record in matching_datasource.iter_rows()
+            ]
         )
 
         primary_key = self.request.data["primaryKey"]
         primary_datasource = Datasource.objects.get(id=primary_key["datasource"])
         primary_keys = set(
-            [record[primary_key["field"]] for record in primary_datasource["data"]]
+            [record[primary_key["field"]] for record in primary_datasource.iter_rows()]
         )
 
         response = {}
@@ -414,8 +468,7 @@ class DatasourceViewSet(viewsets.ModelViewSet):
                 raise ValidationError("Error reading file from s3 bucket")
 
         try:
-            workbook = open_workbook(file_contents=file.read())
-            sheetnames = workbook.sheet_names()
+            sheetnames = retrieve_excel_sheetnames(file)
             data = {"sheetnames": sheetnames}
             return JsonResponse(data)
         except:
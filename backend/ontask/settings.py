@@ -37,6 +37,41 @@ if os.environ.get('ONTASK_DEVELOPMENT') is not None:
 elif os.environ.get('ONTASK_DEMO') is not None:
     from config.demo import *
 
+elif os.environ.get('ONTASK_TEST') is not None:
+    # Self-contained settings for running the tests, which use an in-memory
+    # database if mongomock is installed (or otherwise a local database, without
+    # which the tests that need one are skipped) unless a database host is given
+    try:
+        import mongomock
+        TEST_NOSQL_HOST = 'mongomock://localhost'
+    except ImportError:
+        TEST_NOSQL_HOST = 'mongodb://localhost'
+
+    SECRET_KEY = 'b250YXNrLXRlc3Qtc2VjcmV0LWtleS0wMDAwMDAwMDA='
+    DEBUG = True
+    LTI_CONFIG = {}
+    AAF_CONFIG = {}
+    ADMINS = []
+    DEMO_BUCKET = None
+    SMTP = {
+        'HOST': 'localhost',
+        'PORT': 8025,
+        'USER': 'ontask@localhost',
+        'PASSWORD': '',
+        'USE_TLS': False
+    }
+    FRONTEND_DOMAIN = 'http://localhost:3000'
+    BACKEND_DOMAIN = 'http://localhost:8000'
+    ALLOWED_HOSTS = ['localhost']
+    SQL_DATABASE = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:'
+    }
+    NOSQL_DATABASE = {
+        'HOST': os.environ.get('ONTASK_TEST_NOSQL_HOST', TEST_NOSQL_HOST),
+        'DB': 'ontask'
+    }
+
 else:
     from config.prod import *
 
@@ -174,3 +209,49 @@ DB_DRIVER_MAPPING = {
     "postgresql": "postgresql",
     "mysql":"mysql+pymysql"
 }
+
+# Number of datasource rows that are written to or read from the application
+# database in a single batch
+DATASOURCE_BATCH_SIZE = 1000
+
+# Connection pooling for the external databases of SQL datasources. Engines are
+# shared process-wide, keyed by their connection parameters.
+SQL_ENGINE_POOL = {
+    'POOL_SIZE': 2, # Persistent connections kept per engine
+    'MAX_OVERFLOW': 2, # Additional connections allowed under load
+    'POOL_RECYCLE': 1800, # Seconds after which a connection is re-established
+    'IDLE_TIMEOUT': 900, # Seconds after which an unused engine is disposed
+    'MAX_ENGINES': 20 # Engines kept per process (least recently used are disposed)
+}
+
+# Number of historical snapshots of a datasource's data that are kept. Snapshots
+# are stored as compressed column chunks of DATASOURCE_BATCH_SIZE rows each.
+DATASOURCE_SNAPSHOT_RETENTION = 5
+
+# Per-process cache of the data built by DataLab steps, which is reused when the
+# steps and the versions of their inputs are unchanged (including when building
+# only the first few steps, e.g. to check for discrepencies)
+DATALAB_BUILD_CACHE = {
+    'MAX_ENTRIES': 64,
+    'MAX_CELLS': 5000000 # Total number of values (i.e. records x fields) cached
+}
+
+# Optional parallel DataLab builds, in which the records are hash-partitioned by
+# the field that the modules are joined on, and the partitions are built in a pool
+# of WORKERS processes. Builds of fewer than MIN_RECORDS records (or which can't be
+# partitioned, e.g. because modules are joined on different fields) are built serially.
+DATALAB_PARALLEL_BUILD = {
+    'WORKERS': int(os.environ.get('ONTASK_BUILD_WORKERS', 1)), # 1 disables parallel builds
+    'MIN_RECORDS': 50000
+}
+
+# Store the data of DataLabs as one document per record (which are indexed by the
+# primary keys of forms and the permission fields of web forms), rather than inline
+# in the DataLab document. Existing DataLabs are converted when next rebuilt. Only
+# records that are stored row by row are filtered, searched and sorted by way of
+# indexes; otherwise each filtered or sorted page reads and scans the whole data.
+DATALAB_ROW_STORAGE = os.environ.get('ONTASK_DATALAB_ROW_STORAGE') in ('1', 'true', 'True')
+
+# Number of SMTP sessions that emails are sent over concurrently, which are kept
+# open (and reused) between emails rather than connecting for every email
+SMTP_POOL_SIZE = int(os.environ.get('ONTASK_SMTP_POOL_SIZE', 4))
@@ -2,16 +2,16 @@ from celery import shared_task
 from celery.execute import send_task
 from django_celery_beat.models import PeriodicTask
 
-from pymongo import MongoClient
 from bson.objectid import ObjectId
 import json
-from datetime import datetime
 
-from datasource.utils import retrieve_sql_data, retrieve_file_from_s3
+from datasource.models import Datasource
+from datalab.models import Datalab
+from datalab.utils import rebuild_datalab_data, patch_datasource_data
 from workflow.models import Workflow
 from .utils import create_crontab, send_email
 
-from ontask.settings import NOSQL_DATABASE
+from ontask.settings import DATASOURCE_BATCH_SIZE
 
 
 @shared_task
@@ -52,38 +52,71 @@ def refresh_datasource_data(datasource_id):
     """ Reads the query data from the external source and
         inserts the data into the datasource """
 
-    # Retrieve the datasource object from the application database
-    client = MongoClient(NOSQL_DATABASE["HOST"])
-    db = client[NOSQL_DATABASE["DB"]]
+    # The rows of the datasource are stored outside of the datasource document,
+    # so the document itself is cheap to load
+    datasource = Datasource.objects.get(id=ObjectId(datasource_id))
+    since = datasource.snapshot
+    changes = datasource.refresh_data()
+
+    if not changes or not any(changes.values()):
+        return "Data unchanged"
+
+    # If only a batch of rows or fewer were updated, then the records of the
+    # DataLabs that they are combined into are updated in place (as beyond that
+    # it is cheaper to rebuild the data than to update the records one by one)
+    is_update = not (changes["full"] or changes["inserted"] or changes["deleted"])
+    if is_update and len(changes["updated"]) <= DATASOURCE_BATCH_SIZE:
+        refresh_dependent_datalabs(datasource.id, since, changes["updated"])
+    else:
+        refresh_dependent_datalabs(datasource.id)
+
+    if not changes["full"]:
+        return "Data refreshed incrementally - %d inserted, %d updated, %d deleted" % (
+            len(changes["inserted"]),
+            len(changes["updated"]),
+            len(changes["deleted"]),
+        )
+
+    return "Data imported successfully"
 
-    # Project only the connection details of the datasource, and exclude all other fields
-    datasource = db.datasource.find_one(
-        {"_id": ObjectId(datasource_id)}, {"connection": 1}
-    )
 
-    connection = datasource["connection"]
+@shared_task
+def refresh_datalab_data(datalab_id, datasource_id=None, since=None, updated=None):
+    """ Rebuilds the data of a DataLab after its datasources have changed. If
+        the primary keys of the rows updated by an incremental refresh of a
+        datasource are given, then only the records combined from those rows
+        are updated where possible. """
 
-    # Retrieve the query data based on the datasource type
-    datasource_type = connection["dbType"]
-    if datasource_type in ["mysql", "postgresql"]:
-        data = retrieve_sql_data(connection)
-    elif datasource_type == "s3BucketFile":
-        data = retrieve_file_from_s3(connection)
+    datalab = Datalab.objects.get(id=ObjectId(datalab_id))
 
-    fields = list(data[0].keys())
+    if updated is not None and patch_datasource_data(
+        datalab, datasource_id, since, updated
+    ):
+        return "DataLab data updated - %d rows" % len(updated)
 
-    db.datasource.update(
-        {"_id": ObjectId(datasource_id)},
-        {"$set": {"data": data, "fields": fields, "lastUpdated": datetime.utcnow()}},
-    )
+    if not rebuild_datalab_data(datalab):
+        return "DataLab data unchanged"
 
-    return "Data imported successfully"
+    return "DataLab data refreshed successfully"
+
+
+def refresh_dependent_datalabs(datasource_id, since=None, updated=None):
+    """ Queues the rebuild of the data of each DataLab that uses the datasource,
+        or the update of the records combined from the given updated rows of
+        the datasource (see refresh_datalab_data) """
+
+    datalabs = Datalab.objects(steps__datasource__id=str(datasource_id)).only("id")
+    for datalab in datalabs:
+        refresh_datalab_data.delay(str(datalab.id), str(datasource_id), since, updated)
 
 
 @shared_task
 def workflow_send_email(action_id):
     """ Send email based on the schedule in workflow model """
     action = Workflow.objects.get(id=ObjectId(action_id))
-    action.send_email("Scheduled")
+    failed_recipients = action.send_email("Scheduled")
+
+    if failed_recipients:
+        return f"Emails failed to send to {len(failed_recipients)} recipient(s)"
 
     return "Emails sent successfully"
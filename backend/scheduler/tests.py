@@ -0,0 +1,207 @@
+import asyncore
+import smtpd
+import threading
+from contextlib import ExitStack
+from unittest import mock, SkipTest
+
+from django.test import SimpleTestCase
+from mongoengine.connection import get_db, register_connection
+from mongoengine.context_managers import switch_db
+from pymongo.errors import ConnectionFailure
+
+from container.models import Container
+from datalab.models import Datalab
+from workflow.models import Workflow, EmailSettings, EmailCounter
+
+from . import utils
+from .utils import send_emails
+
+from ontask.settings import NOSQL_DATABASE
+
+TEST_DB_ALIAS = "test"
+TEST_DB_NAME = f"{NOSQL_DATABASE['DB']}_test"
+
+
+class SinkChannel(smtpd.SMTPChannel):
+    def smtp_RCPT(self, arg):
+        # Recipients can be refused by the server, or cause it to drop the
+        # connection part way through sending a message
+        if arg and "refused" in arg:
+            self.push("550 No such user")
+        elif arg and "dropped" in arg:
+            self.close()
+        else:
+            super().smtp_RCPT(arg)
+
+
+class SinkServer(smtpd.SMTPServer):
+    """ Local SMTP server which accepts every message (other than those to the
+        recipients that it refuses) without delivering it """
+
+    channel_class = SinkChannel
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), None, decode_data=True)
+        self.connections = 0
+        self.recipients = []
+
+    def handle_accepted(self, conn, addr):
+        self.connections += 1
+        super().handle_accepted(conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        self.recipients.extend(rcpttos)
+
+
+class SMTPSinkTestCase(SimpleTestCase):
+    """ Emails are sent to a local SMTP sink, which is started for each test """
+
+    pool_size = 2
+
+    def setUp(self):
+        self.sink = SinkServer()
+        self.sink_thread = threading.Thread(
+            target=asyncore.loop, kwargs={"timeout": 0.05}
+        )
+        self.sink_thread.start()
+
+        host, port = self.sink.socket.getsockname()
+        smtp = {"HOST": host, "PORT": port, "PASSWORD": "", "USE_TLS": False}
+        self.patches = ExitStack()
+        self.patches.enter_context(mock.patch.dict(utils.SMTP, smtp))
+        self.patches.enter_context(
+            mock.patch.object(utils, "SMTP_POOL_SIZE", self.pool_size)
+        )
+
+    def tearDown(self):
+        while not utils.smtp_sessions.empty():
+            utils.close_smtp_session(utils.smtp_sessions.get_nowait())
+
+        asyncore.close_all()
+        self.sink_thread.join()
+        self.patches.close()
+
+
+class SendEmailsTest(SMTPSinkTestCase):
+    def emails(self, recipients):
+        return [
+            (recipient, "Subject", f"<p>{index}</p>", None)
+            for (index, recipient) in enumerate(recipients)
+        ]
+
+    def test_sessions_are_pooled(self):
+        recipients = [f"student{index}@test" for index in range(10)]
+
+        self.assertEqual(send_emails(self.emails(recipients)), [True] * 10)
+        self.assertEqual(sorted(self.sink.recipients), sorted(recipients))
+        self.assertEqual(self.sink.connections, self.pool_size)
+
+        # The sessions are reused by subsequent sends
+        self.assertEqual(send_emails(self.emails(recipients)), [True] * 10)
+        self.assertEqual(self.sink.connections, self.pool_size)
+
+    def test_refused_recipient(self):
+        recipients = ["first@test", "refused@test", "second@test", "third@test"]
+
+        results = send_emails(self.emails(recipients))
+
+        self.assertEqual(results, [True, False, True, True])
+        self.assertEqual(
+            sorted(self.sink.recipients), ["first@test", "second@test", "third@test"]
+        )
+        # The session remains usable after a recipient is refused
+        self.assertEqual(self.sink.connections, self.pool_size)
+
+    def test_invalid_recipients_are_not_sent(self):
+        recipients = [None, "", "not an address", "first@test, second@test"]
+
+        self.assertEqual(send_emails(self.emails(recipients)), [False] * 4)
+        self.assertEqual(self.sink.connections, 0)
+
+    def test_dropped_connection_is_not_retried(self):
+        with mock.patch.object(utils, "SMTP_POOL_SIZE", 1):
+            results = send_emails(
+                self.emails(["first@test", "dropped@test", "second@test"])
+            )
+
+        self.assertEqual(results, [True, False, True])
+        self.assertEqual(sorted(self.sink.recipients), ["first@test", "second@test"])
+        # The message after the dropped connection is sent over a new session
+        self.assertEqual(self.sink.connections, 2)
+
+    def test_idle_sessions_dropped_by_the_server_are_replaced(self):
+        send_emails(self.emails(["first@test"]))
+        for channel in list(asyncore.socket_map.values()):
+            if isinstance(channel, SinkChannel):
+                channel.close()
+
+        self.assertEqual(send_emails(self.emails(["second@test"])), [True])
+        self.assertEqual(sorted(self.sink.recipients), ["first@test", "second@test"])
+        self.assertEqual(self.sink.connections, 2)
+
+
+class WorkflowSendEmailTest(SMTPSinkTestCase):
+    """ The recipients that an action's emails failed to be sent to are
+        recorded against the email job """
+
+    @classmethod
+    def setUpClass(cls):
+        register_connection(
+            TEST_DB_ALIAS,
+            name=TEST_DB_NAME,
+            host=NOSQL_DATABASE["HOST"],
+            serverSelectionTimeoutMS=2000,
+        )
+        try:
+            get_db(TEST_DB_ALIAS).client.server_info()
+        except ConnectionFailure:
+            raise SkipTest("The database is not available")
+
+        super().setUpClass()
+
+        cls.switched_documents = ExitStack()
+        for document in [Container, Datalab, Workflow, EmailCounter]:
+            cls.switched_documents.enter_context(switch_db(document, TEST_DB_ALIAS))
+
+    @classmethod
+    def tearDownClass(cls):
+        get_db(TEST_DB_ALIAS).client.drop_database(TEST_DB_NAME)
+        cls.switched_documents.close()
+        super().tearDownClass()
+
+    def test_failed_recipients(self):
+        container = Container(owner="owner@test", code="TEST")
+        container.save()
+
+        records = [
+            {"email": "first@test"},
+            {"email": "refused@test"},
+            {"email": None},
+            {"email": "second@test"},
+        ]
+        datalab = Datalab(container=container, name="datalab", data=records)
+        datalab.save()
+
+        action = Workflow(
+            container=container,
+            datalab=datalab,
+            name="action",
+            content={
+                "blockMap": {"document": {"nodes": [{"type": "paragraph"}]}},
+                "html": ["<p>Content</p>"],
+            },
+            emailSettings=EmailSettings(
+                subject="Subject", field="email", replyTo="owner@test"
+            ),
+        )
+        action.save()
+
+        failed_recipients = action.send_email("Manual")
+
+        self.assertEqual(failed_recipients, ["refused@test", ""])
+        job = Workflow.objects.get(id=action.id).emailJobs[0]
+        self.assertEqual(job.failed_recipients, ["refused@test", ""])
+        self.assertEqual(
+            [email.recipient for email in job.emails], ["first@test", "second@test"]
+        )
+        self.assertEqual(sorted(self.sink.recipients), ["first@test", "second@test"])
@@ -1,17 +1,24 @@
 from django_celery_beat.models import CrontabSchedule, IntervalSchedule
 
 import os
+import re
 import json
 from dateutil import parser
 from uuid import uuid4
 
 import smtplib
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.header import Header
 from email.utils import formataddr
 
-from ontask.settings import SMTP
+from ontask.settings import SMTP, SMTP_POOL_SIZE
+
+# Idle SMTP sessions (which are already authenticated) that are reused to send
+# subsequent emails, rather than connecting and logging in for every email
+smtp_sessions = queue.LifoQueue()
 
 
 def generate_task_name(task):
@@ -50,34 +57,171 @@ def create_crontab(schedule):
     return periodic_schedule
 
 
-def send_email(recipient, subject, content, reply_to=None, force_send=False):
-    '''Generic service to send email from the application'''
+def create_message(recipient, subject, content, reply_to=None):
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = subject
+    if 'NAME' in SMTP:
+        msg['From'] = formataddr((str(Header(SMTP['NAME'], 'utf-8')), SMTP['USER']))
+    else:
+        msg['From'] = SMTP['USER']
+    msg['To'] = recipient
+    if reply_to:
+        msg['Reply-To'] = reply_to
+
+    msg.attach(MIMEText(content, 'html'))
+    return msg.as_string()
+
+
+def open_smtp_session():
+    session = smtplib.SMTP(host=SMTP['HOST'], port=SMTP['PORT'])
+    if SMTP['USE_TLS']:
+        session.starttls()
+
+    # SMTP servers which don't require authentication (e.g. a local relay) are
+    # configured without a password
+    if SMTP.get('PASSWORD'):
+        session.login(SMTP['USER'], SMTP['PASSWORD'])
+
+    return session
+
+
+def close_smtp_session(session):
+    try:
+        session.quit()
+    except Exception:
+        # The connection has already been dropped
+        session.close()
+
+
+def is_smtp_session_alive(session):
+    try:
+        return session.noop()[0] == 250
+    except Exception:
+        return False
+
+
+def acquire_smtp_session():
+    # Sessions which have been dropped by the server while idle are discarded
+    while True:
+        try:
+            session = smtp_sessions.get_nowait()
+        except queue.Empty:
+            return open_smtp_session()
+
+        if is_smtp_session_alive(session):
+            return session
+        close_smtp_session(session)
+
+
+def release_smtp_session(session):
+    if smtp_sessions.qsize() < SMTP_POOL_SIZE:
+        smtp_sessions.put(session)
+    else:
+        close_smtp_session(session)
+
+
+def send_messages(messages):
+    '''Send (recipient, message) pairs in order over a single pooled session,
+    returning whether each message was sent. Messages are not retried, as a
+    message may have been delivered even if the connection failed while sending
+    it. Instead the next message is sent over a new session.'''
+
+    results = []
+    session = None
+    for (recipient, message) in messages:
+        if session is None:
+            try:
+                session = acquire_smtp_session()
+            except Exception as err:
+                # The server can't be reached, so the remaining messages fail
+                print(err)
+                return results + [False] * (len(messages) - len(results))
+
+        try:
+            session.sendmail(SMTP['USER'], recipient, message)
+            results.append(True)
+        except smtplib.SMTPRecipientsRefused as err:
+            # The session remains usable for other recipients
+            print(err)
+            results.append(False)
+        except smtplib.SMTPResponseException as err:
+            # As it does for other rejected messages, unless the server is
+            # closing the connection
+            print(err)
+            results.append(False)
+            if err.smtp_code == 421:
+                close_smtp_session(session)
+                session = None
+        except Exception as err:
+            print(err)
+            results.append(False)
+            close_smtp_session(session)
+            session = None
+
+    if session is not None:
+        release_smtp_session(session)
+
+    return results
+
+
+def is_valid_recipient(recipient):
+    # A single email address, without a display name
+    return isinstance(recipient, str) and bool(
+        re.fullmatch(r'[^@\s,;<>"]+@[^@\s,;<>"]+', recipient.strip())
+    )
+
+
+def send_emails(emails, force_send=False):
+    '''Send many emails, each given as (recipient, subject, content, reply_to),
+    over up to SMTP_POOL_SIZE concurrent sessions. Returns whether each email
+    was sent (emails to invalid recipients are not sent at all)'''
 
     if not force_send and os.environ.get('ONTASK_DEMO') is not None:
         raise Exception("Email sending is disabled in the demo")
 
-    try:
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = subject
-        if 'NAME' in SMTP:
-            msg['From'] = formataddr((str(Header(SMTP['NAME'], 'utf-8')), SMTP['USER']))
-        else:
-            msg['From'] = SMTP['USER']
-        msg['To'] = recipient
-        if reply_to:
-            msg['Reply-To'] = reply_to
-
-        msg.attach(MIMEText(content, 'html'))
-
-        s = smtplib.SMTP(host=SMTP['HOST'], port=SMTP['PORT'])
-        if SMTP['USE_TLS']:
-            s.starttls()
-
-        s.login(SMTP['USER'], SMTP['PASSWORD'])
-        s.sendmail(SMTP['USER'], recipient, msg.as_string())
-        s.quit()
-        return True
-
-    except Exception as err:
-        print(err)
+    # The position of each message that is sent among the emails
+    positions = []
+    messages = []
+    for (position, (recipient, subject, content, reply_to)) in enumerate(emails):
+        if not is_valid_recipient(recipient):
+            print(f"Invalid recipient: {recipient}")
+            continue
+
+        recipient = recipient.strip()
+        positions.append(position)
+        messages.append(
+            (recipient, create_message(recipient, subject, content, reply_to))
+        )
+
+    results = [False] * len(emails)
+    if not messages:
+        return results
+
+    # Each session sends an interleaved share of the messages
+    sessions = min(SMTP_POOL_SIZE, len(messages))
+    if sessions == 1:
+        shares = [send_messages(messages)]
+    else:
+        with ThreadPoolExecutor(sessions) as executor:
+            shares = list(
+                executor.map(
+                    send_messages, [messages[i::sessions] for i in range(sessions)]
+                )
+            )
+
+    sent = [False] * len(messages)
+    for (i, share) in enumerate(shares):
+        sent[i::sessions] = share
+    for (position, is_sent) in zip(positions, sent):
+        results[position] = is_sent
+
+    return results
+
+
+def send_email(recipient, subject, content, reply_to=None, force_send=False):
+    '''Generic service to send email from the application'''
+
+    if not send_emails([(recipient, subject, content, reply_to)], force_send)[0]:
         raise Exception("Error sending email")
+
+    return True
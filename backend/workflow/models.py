@@ -14,16 +14,22 @@ from mongoengine.fields import (
     BaseField,
 )
 from datetime import datetime
-from collections import defaultdict
 from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
 import jwt
 
 from container.models import Container
 from datalab.models import Datalab
+from datalab.storage import load_data
 from datasource.models import Datasource
 
-from .utils import did_pass_test, parse_content_line
-from scheduler.utils import send_email
+from .utils import (
+    filter_records,
+    assign_rules,
+    compile_content_line,
+    render_content_line,
+)
+from scheduler.utils import send_emails
 
 from ontask.settings import SECRET_KEY, BACKEND_DOMAIN, FRONTEND_DOMAIN
 
@@ -109,6 +115,8 @@ class EmailJob(EmbeddedDocument):
     type = StringField(choices=["Manual", "Scheduled"])
     initiated_at = DateTimeField(default=datetime.utcnow)
     included_feedback = BooleanField()
+    # Recipients that the email failed to be sent to
+    failed_recipients = ListField(StringField())
 
 
 class Workflow(Document):
@@ -129,89 +137,26 @@ class Workflow(Document):
     emailJobs = EmbeddedDocumentListField(EmailJob)
 
     @property
-    def options(self):
-        modules = []
-        types = {}
-        labels = []
-
-        # Create a "pseudo" module to hold the computed fields
-        computed = {"type": "computed", "fields": []}
-
-        # Iterate over the modules of the datalab
-        for step in self.datalab.steps:
-            module = {"type": step.type, "fields": []}
-            module_labels = {}
-
-            if step.type == "datasource":
-                module["name"] = Datasource.objects.get(id=step.datasource.id).name
-                for field in step.datasource.fields:
-                    label = step.datasource.labels[field]
-                    module["fields"].append(label)
-                    types[label] = step.datasource.types[field]
-                    module_labels[field] = label
-                modules.append(module)
-                labels.append(module_labels)
+    def state(self):
+        """ The values computed from the DataLab for this workflow, which are
+            shared by every consumer (e.g. the serializer, content previews and
+            emails) for as long as this instance is used, i.e. for the duration
+            of a request or task """
 
-            if step.type == "form":
-                module["name"] = step.form.name
-                for field in step.form.fields:
-                    module["fields"].append(field.name)
-                    types[field.name] = field.type
-                    module_labels[field.name] = field.name
-                modules.append(module)
-                labels.append(module_labels)
+        datalab_key = (self.datalab.id, self.datalab.rowVersion)
+        state = getattr(self, "_state", None)
+        if state is None or state.datalab_key != datalab_key:
+            state = self._state = ComputedState(self, datalab_key)
 
-            if step.type == "computed":
-                for field in step.computed.fields:
-                    computed["fields"].append(field.name)
-                    types[field.name] = field.type
-                    module_labels[field.name] = field.name
-                    labels.append(module_labels)
-
-        modules.append(computed)
+        return state
 
-        return {"modules": modules, "types": types, "labels": labels}
+    @property
+    def options(self):
+        return self.state.options
 
     @property
     def data(self):
-        options = self.options
-
-        if self.filter:
-            filtered_data = []
-
-            types = options["types"]
-            parameters = self.filter.parameters
-            condition = self.filter.conditions[0]
-
-            for item in self.datalab.data:
-                if all(
-                    [
-                        did_pass_test(
-                            condition.formulas[parameter_index],
-                            item.get(parameter),
-                            types.get(parameter),
-                        )
-                        for parameter_index, parameter in enumerate(parameters)
-                    ]
-                ):
-                    filtered_data.append(item)
-
-        else:
-            filtered_data = self.datalab.data
-
-        labels = options["labels"]
-        column_order = []
-        for item in self.datalab.order:
-            step_index = item["stepIndex"]
-            field = item["field"]
-            column_order.append(labels[step_index][field])
-
-        return {
-            "records": filtered_data,
-            "order": column_order,
-            "unfilteredLength": len(self.datalab.data),
-            "filteredLength": len(filtered_data),
-        }
+        return self.state.data
 
     def populate_content(self, content=None):
         if not content and not self.content:
@@ -220,50 +165,36 @@ class Workflow(Document):
             content = self.content
 
         filtered_data = self.data["records"]
-        types = self.options["types"]
 
-        # Assign each record to the rule groups
-        populated_rules = defaultdict(set)
-        for item_index, item in enumerate(filtered_data):
-            for rule in self.rules:
-                parameters = rule.parameters
-                did_match = False
-
-                for condition in rule.conditions:
-                    if all(
-                        [
-                            did_pass_test(
-                                condition.formulas[parameter_index],
-                                item.get(parameter),
-                                types.get(parameter),
-                            )
-                            for parameter_index, parameter in enumerate(parameters)
-                        ]
-                    ):
-                        did_match = True
-                        populated_rules[condition.conditionId].add(item_index)
-                        break
-
-                if not did_match:
-                    populated_rules[rule.catchAll].add(item_index)
+        # The rule groups to which each record is assigned
+        populated_rules = self.state.rule_groups
 
         block_map = content["blockMap"]["document"]["nodes"]
         html = content["html"]
         result = []
 
+        # Compile the content once, along with the group of records that each
+        # condition block is shown to (conditions without a group are skipped)
+        compiled_blocks = []
+        for block_index, block in enumerate(block_map):
+            if block["type"] == "condition":
+                condition_id = block["data"]["conditionId"]
+                group = populated_rules.get(ObjectId(condition_id))
+                if group is None:
+                    continue
+                group = group.tolist()
+            else:
+                group = None
+            compiled_blocks.append((group, compile_content_line(html[block_index])))
+
         # Populate the content for each record
         for item_index, item in enumerate(filtered_data):
-            populated_content = ""
-
-            for block_index, block in enumerate(block_map):
-                if block["type"] == "condition":
-                    condition_id = block["data"]["conditionId"]
-                    if item_index in populated_rules.get(ObjectId(condition_id), {}):
-                        populated_content += parse_content_line(html[block_index], item)
-                else:
-                    populated_content += parse_content_line(html[block_index], item)
+            parts = []
+            for (group, line) in compiled_blocks:
+                if group is None or group[item_index]:
+                    render_content_line(line, item, parts)
 
-            result.append(populated_content)
+            result.append("".join(parts))
 
         return result
 
@@ -297,7 +228,7 @@ class Workflow(Document):
             emails=[],
         )
 
-        failed_emails = False
+        emails = []
         for index, item in enumerate(self.data["records"]):
             recipient = item.get(email_settings.field)
             email_content = populated_content[index]
@@ -327,10 +258,20 @@ class Workflow(Document):
                     f"feedback by <a href='{feedback_link}'>clicking here</a>.</p>"
                 )
 
-            email_sent = send_email(
-                recipient, email_settings.subject, email_content, email_settings.replyTo
+            emails.append(
+                (
+                    recipient,
+                    email_settings.subject,
+                    email_content,
+                    email_settings.replyTo,
+                )
             )
 
+        # The emails are sent over a pool of SMTP sessions
+        emails_sent = send_emails(emails)
+
+        for index, email_sent in enumerate(emails_sent):
+            recipient = emails[index][0]
             if email_sent:
                 job.emails.append(
                     Email(
@@ -340,14 +281,198 @@ class Workflow(Document):
                     )
                 )
             else:
-                failed_emails = True
+                # Records without a value for the email field are denoted by ""
+                job.failed_recipients.append(recipient or "")
 
-        # if failed_emails:
-        # TODO: Make these records identifiable, e.g. allow user to specify the primary key of the DataLab?
-        # And send back a list of the specific records that we failed to send an email to
-        # raise ValidationError('Emails to the some records failed to send: ' + str(failed_emails).strip('[]').strip("'"))
+        # None of the emails could be sent, e.g. the SMTP server is unreachable
+        if job.failed_recipients and not job.emails:
+            raise Exception("Error sending email")
 
         self.emailJobs.append(job)
         self.emailSettings = email_settings
 
         self.save()
+
+        EmailCounter.create_for_job(self.datalab.id, self.id, job)
+
+        return job.failed_recipients
+
+
+class ComputedState:
+    """ The options, filtered data and rule groups of a workflow, which are
+        each computed on first use. A new state is created if the id or row
+        version of the DataLab changes, whereas the filtered data and rule
+        groups are recomputed if the filter or rules of the workflow change. """
+
+    def __init__(self, workflow, datalab_key):
+        self.workflow = workflow
+        self.datalab_key = datalab_key
+        self.computed = {}
+
+    def memoise(self, name, key, compute):
+        if name not in self.computed or self.computed[name][0] != key:
+            self.computed[name] = (key, compute())
+
+        return self.computed[name][1]
+
+    @property
+    def filter_key(self):
+        workflow_filter = self.workflow.filter
+        return workflow_filter.to_mongo() if workflow_filter else None
+
+    @property
+    def rules_key(self):
+        return [rule.to_mongo() for rule in self.workflow.rules]
+
+    @property
+    def options(self):
+        return self.memoise("options", None, self.compute_options)
+
+    @property
+    def records(self):
+        return self.memoise("records", None, lambda: load_data(self.workflow.datalab))
+
+    @property
+    def data(self):
+        return self.memoise("data", self.filter_key, self.compute_data)
+
+    @property
+    def rule_groups(self):
+        key = (self.filter_key, self.rules_key)
+        return self.memoise("rule_groups", key, self.compute_rule_groups)
+
+    def compute_options(self):
+        steps = self.workflow.datalab.steps
+        modules = []
+        types = {}
+        labels = []
+
+        # Create a "pseudo" module to hold the computed fields
+        computed = {"type": "computed", "fields": []}
+
+        # Retrieve the names of the datasources in a single query
+        datasource_ids = [
+            step.datasource.id for step in steps if step.type == "datasource"
+        ]
+        datasource_names = {
+            str(datasource.id): datasource.name
+            for datasource in Datasource.objects(id__in=datasource_ids).only("name")
+        }
+
+        # Iterate over the modules of the datalab
+        for step in steps:
+            module = {"type": step.type, "fields": []}
+            module_labels = {}
+
+            if step.type == "datasource":
+                module["name"] = datasource_names[step.datasource.id]
+                for field in step.datasource.fields:
+                    label = step.datasource.labels[field]
+                    module["fields"].append(label)
+                    types[label] = step.datasource.types[field]
+                    module_labels[field] = label
+                modules.append(module)
+                labels.append(module_labels)
+
+            if step.type == "form":
+                module["name"] = step.form.name
+                for field in step.form.fields:
+                    module["fields"].append(field.name)
+                    types[field.name] = field.type
+                    module_labels[field.name] = field.name
+                modules.append(module)
+                labels.append(module_labels)
+
+            if step.type == "computed":
+                for field in step.computed.fields:
+                    computed["fields"].append(field.name)
+                    types[field.name] = field.type
+                    module_labels[field.name] = field.name
+                    labels.append(module_labels)
+
+        modules.append(computed)
+
+        return {"modules": modules, "types": types, "labels": labels}
+
+    def compute_data(self):
+        workflow = self.workflow
+        options = self.options
+
+        data = self.records
+
+        if workflow.filter:
+            filtered_data = filter_records(data, workflow.filter, options["types"])
+        else:
+            filtered_data = data
+
+        labels = options["labels"]
+        column_order = []
+        for item in workflow.datalab.order:
+            step_index = item["stepIndex"]
+            field = item["field"]
+            column_order.append(labels[step_index][field])
+
+        return {
+            "records": filtered_data,
+            "order": column_order,
+            "unfilteredLength": len(data),
+            "filteredLength": len(filtered_data),
+        }
+
+    def compute_rule_groups(self):
+        return assign_rules(
+            self.data["records"], self.workflow.rules, self.options["types"]
+        )
+
+
+class EmailCounter(Document):
+    # Materialised tracking and feedback counts of an email sent to a recipient
+    # by an action, which are consumed by the computed fields of the DataLab
+    datalab = ObjectIdField(required=True)
+    # Cascade delete if the action is deleted
+    action = ReferenceField(Workflow, required=True, reverse_delete_rule=2)
+    job = ObjectIdField(required=True)
+    recipient = StringField(required=True)
+    tracking = IntField(default=0)  # Number of times the email was opened
+    feedback = IntField(default=0)  # Number of times feedback was submitted
+
+    meta = {
+        "indexes": [
+            "datalab",
+            {"fields": ("action", "job", "recipient"), "unique": True},
+        ]
+    }
+
+    @classmethod
+    def create_for_job(cls, datalab_id, action_id, job):
+        """ Create the counters of the emails of an email job, starting from the
+            counts recorded against the emails themselves """
+
+        counters = {}
+        for email in job.emails:
+            if email.recipient and email.recipient not in counters:
+                counters[email.recipient] = {
+                    "datalab": ObjectId(datalab_id),
+                    "action": action_id,
+                    "job": job.job_id,
+                    "recipient": email.recipient,
+                    "tracking": email.track_count or 0,
+                    "feedback": 1 if email.feedback_datetime else 0,
+                }
+
+        if not counters:
+            return []
+
+        try:
+            cls._get_collection().insert_many(list(counters.values()), ordered=False)
+        except BulkWriteError:
+            # The counters of the job have already been (partially) created
+            pass
+
+        return list(counters.values())
+
+    @classmethod
+    def increment(cls, action_id, job_id, recipient, counter):
+        cls.objects(action=action_id, job=job_id, recipient=recipient).update_one(
+            **{f"inc__{counter}": 1}
+        )
@@ -1,7 +1,11 @@
-import re
 from dateutil import parser
+import numpy as np
+import operator
+import re
 import time
 
+from datasource.dataset import MISSING, Dataset
+
 
 def transform(value, param_type):
     try:
@@ -18,48 +22,213 @@ def transform(value, param_type):
         return None
 
 
-def did_pass_test(test, value, param_type):
-    value = transform(value, param_type)
-    if "comparator" in test:
-        comparator = transform(test["comparator"], param_type)
+def cast_column(values, param_type):
+    """ Group the records by their value of a column, as a list of (transformed
+        value, indices of the records), so that each distinct value is only
+        transformed (and tested) once """
+
+    groups = {}
+    unhashable = []
+    for (index, value) in enumerate(values):
+        try:
+            groups.setdefault(value, []).append(index)
+        except TypeError:
+            # Unhashable values (e.g. lists) are kept as groups of their own
+            unhashable.append((value, [index]))
+
+    return [
+        (transform(value, param_type), indices)
+        for (value, indices) in list(groups.items()) + unhashable
+    ]
+
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def never(value):
+    return False
+
+
+def compile_formula(formula, param_type):
+    """ Compile a formula into a predicate of a transformed value, in which the
+        comparator (or range) of the formula is only transformed once """
+
+    test_operator = formula["operator"]
+    has_comparator = "comparator" in formula
+
+    if has_comparator:
+        comparator = transform(formula["comparator"], param_type)
+
+    if test_operator in COMPARISONS:
+        if not has_comparator:
+            return never
+        compare = COMPARISONS[test_operator]
+
+        def predicate(value):
+            try:
+                return compare(value, comparator)
+            except Exception:
+                return False
+
+    elif test_operator == "between":
+        (range_from, range_to) = (formula["rangeFrom"], formula["rangeTo"])
+        if not has_comparator:
+            range_from = transform(range_from, param_type)
+            range_to = transform(range_to, param_type)
+
+        def predicate(value):
+            try:
+                return value >= range_from and value <= range_to
+            except Exception:
+                return False
+
+    elif test_operator == "contains":
+        if not has_comparator or not isinstance(comparator, str):
+            return never
+        comparator = comparator.lower()
+
+        def predicate(value):
+            try:
+                return comparator in (item.lower() for item in value)
+            except Exception:
+                return False
+
     else:
-        test["rangeFrom"] = transform(test["rangeFrom"], param_type)
-        test["rangeTo"] = transform(test["rangeTo"], param_type)
+        return never
 
-    operator = test["operator"]
+    return predicate
 
-    try:
-        if operator == "==":
-            return value == comparator
-        elif operator == "!=":
-            return value != comparator
-        elif operator == "<":
-            return value < comparator
-        elif operator == "<=":
-            return value <= comparator
-        elif operator == ">":
-            return value > comparator
-        elif operator == ">=":
-            return value >= comparator
-        elif operator == "between":
-            return value >= test["rangeFrom"] and value <= test["rangeTo"]
-        elif operator == "contains":
-            return comparator.lower() in (item.lower() for item in value)
+
+def formula_mask(formula, column, param_type):
+    """ Boolean mask of the records which pass a formula, given the column of
+        the parameter. Number and date formulas are evaluated as comparisons
+        over the typed values of the column, in which values that can't be
+        transformed behave as None does when the formula is tested against a
+        single value (i.e. they are only equal to a comparator which can't be
+        transformed either). Other formulas are tested against each distinct
+        value of the column. """
+
+    test_operator = formula["operator"]
+    has_comparator = "comparator" in formula
+    length = len(column)
+
+    if param_type in ["number", "date"] and not (
+        test_operator == "between" and has_comparator
+    ):
+        if param_type == "number":
+            (values, valid) = column.numbers
         else:
-            return False
-    except:
-        return False
+            (values, valid) = column.timestamps
 
+        if test_operator in COMPARISONS:
+            if not has_comparator:
+                return np.zeros(length, dtype=bool)
+
+            comparator = transform(formula["comparator"], param_type)
+            if comparator is None:
+                if test_operator == "==":
+                    return ~valid
+                if test_operator == "!=":
+                    return valid.copy()
+                return np.zeros(length, dtype=bool)
+
+            with np.errstate(invalid="ignore"):
+                mask = COMPARISONS[test_operator](values, comparator)
+            return mask | ~valid if test_operator == "!=" else mask & valid
+
+        if test_operator == "between":
+            range_from = transform(formula["rangeFrom"], param_type)
+            range_to = transform(formula["rangeTo"], param_type)
+            if range_from is None or range_to is None:
+                return np.zeros(length, dtype=bool)
+
+            with np.errstate(invalid="ignore"):
+                return (values >= range_from) & (values <= range_to) & valid
+
+        # Numbers and dates never contain a comparator
+        return np.zeros(length, dtype=bool)
+
+    predicate = compile_formula(formula, param_type)
+    mask = np.zeros(length, dtype=bool)
+    values = (None if value is MISSING else value for value in column.values)
+    for (value, indices) in cast_column(values, param_type):
+        if predicate(value):
+            mask[indices] = True
+
+    return mask
+
+
+def condition_mask(condition, parameters, types, dataset):
+    """ Boolean mask of the records which pass every formula of a condition """
+
+    mask = np.ones(len(dataset), dtype=bool)
+    for (index, parameter) in enumerate(parameters):
+        mask &= formula_mask(
+            condition.formulas[index], dataset[parameter], types.get(parameter)
+        )
+
+    return mask
+
+
+def filter_records(records, record_filter, types):
+    """ Records which pass the (first condition of the) filter """
+
+    parameters = record_filter.parameters
+    dataset = Dataset.from_rows(records, fields=list(set(parameters)))
+    mask = condition_mask(record_filter.conditions[0], parameters, types, dataset)
+
+    return [records[index] for index in np.flatnonzero(mask)]
+
+
+def assign_rules(records, rules, types):
+    """ Assign each record to the first condition of each rule that it passes,
+        or otherwise to the rule's catch-all group. Returns a map of condition
+        id to the boolean mask of the records in its group. """
+
+    parameters = {parameter for rule in rules for parameter in rule.parameters}
+    dataset = Dataset.from_rows(records, fields=list(parameters))
+
+    groups = {}
+    for rule in rules:
+        remaining = np.ones(len(records), dtype=bool)
+        for condition in rule.conditions:
+            mask = remaining & condition_mask(
+                condition, rule.parameters, types, dataset
+            )
+            groups[condition.conditionId] = mask
+            remaining &= ~mask
+        groups[rule.catchAll] = remaining
+
+    return groups
+
+
+ATTRIBUTE = re.compile(r"<attribute>(.*?)</attribute>")
+
+
+def compile_content_line(line):
+    """ Split a line of content into its literal text and the fields that are
+        substituted between the literals, as (literals, fields) in which there
+        is one more literal than there are fields """
+
+    parts = ATTRIBUTE.split(line)
+    return parts[0::2], parts[1::2]
 
-def populate_field(match, item):
-    field = match.group(1)
-    if field in item:
-        return str(item[field])
-    else:
-        return None
 
+def render_content_line(compiled_line, item, parts):
+    """ Append the parts of a compiled line, populated with the values of the
+        record (or nothing, for fields that the record doesn't have), to the
+        list of parts """
 
-def parse_content_line(line, item):
-    return re.sub(
-        r"<attribute>(.*?)</attribute>", lambda match: populate_field(match, item), line
-    )
+    (literals, fields) = compiled_line
+    parts.append(literals[0])
+    for (field, literal) in zip(fields, literals[1:]):
+        if field in item:
+            parts.append(str(item[field]))
+        parts.append(literal)
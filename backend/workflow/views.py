@@ -15,6 +15,7 @@ import jwt
 from .serializers import ActionSerializer
 from .models import (
     Workflow,
+    EmailCounter,
     EmailSettings,
     EmailJob,
     Email,
@@ -200,9 +201,9 @@ class WorkflowViewSet(viewsets.ModelViewSet):
             raise ValidationError("Email content cannot be empty.")
 
         email_settings = EmailSettings(**request.data["emailSettings"])
-        action.send_email("Manual", email_settings)
+        failed_recipients = action.send_email("Manual", email_settings)
 
-        return Response({"success": "true"})
+        return Response({"success": "true", "failed": failed_recipients})
 
     @list_route(methods=["get"], permission_classes=[])
     def read_receipt(self, request):
@@ -234,6 +235,12 @@ class WorkflowViewSet(viewsets.ModelViewSet):
 
             if did_update:
                 action.save()
+                EmailCounter.increment(
+                    action.id,
+                    ObjectId(decrypted_token["job_id"]),
+                    decrypted_token["recipient"],
+                    "tracking",
+                )
 
         return HttpResponse(PIXEL_GIF_DATA, content_type="image/gif")
 
@@ -290,10 +297,13 @@ class WorkflowViewSet(viewsets.ModelViewSet):
             return JsonResponse({"error": "Empty feedback cannot be submitted"})
 
         did_update = False
+        is_first_feedback = False
         for job in action.emailJobs:
             if str(job.job_id) == job_id and job.included_feedback:
                 for email in job.emails:
                     if email.recipient == request.user.email:
+                        if not email.feedback_datetime:
+                            is_first_feedback = True
                         email.textbox_feedback = textbox
                         email.list_feedback = dropdown
                         email.feedback_datetime = datetime.utcnow()
@@ -301,6 +311,13 @@ class WorkflowViewSet(viewsets.ModelViewSet):
 
         if did_update:
             action.save()
+            # The feedback counter denotes whether the recipient has provided
+            # feedback (as for the counters created from existing jobs), hence
+            # re-submissions of feedback are not counted
+            if is_first_feedback:
+                EmailCounter.increment(
+                    action.id, ObjectId(job_id), request.user.email, "feedback"
+                )
         else:
             # None of the email recipients must have matched the request user's email
             return JsonResponse(
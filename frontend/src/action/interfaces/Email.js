@@ -77,10 +77,18 @@ class Email extends React.Component {
       apiRequest(`/workflow/${action.id}/email/`, {
         method: "POST",
         payload: { emailSettings },
-        onSuccess: () => {
-          notification["success"]({
-            message: "Email(s) successfully sent."
-          });
+        onSuccess: response => {
+          const failed = response.failed || [];
+          if (failed.length > 0) {
+            notification["warning"]({
+              message: `${failed.length} email(s) failed to send.`,
+              description: failed.join(", ")
+            });
+          } else {
+            notification["success"]({
+              message: "Email(s) successfully sent."
+            });
+          }
           this.setState({ sending: false });
         },
         onError: error => this.setState({ error })
@@ -3,6 +3,7 @@ import requestWrapper from "../shared/requestWrapper";
 import { fetchContainers } from "../container/ContainerActions";
 import _ from "lodash";
 import moment from "moment";
+import queryString from "query-string";
 
 export const START_FETCHING = "START_FETCHING";
 export const FINISH_FETCHING = "FINISH_FETCHING";
@@ -85,7 +86,6 @@ const storeDataLab = dataLab => {
       order: dataLab.order ? dataLab.order : [],
       errors: { steps: [] }
     },
-    data: dataLab.data ? dataLab.data : [],
     datasources: dataLab.datasources,
     actions: dataLab.actions
   };
@@ -110,6 +110,21 @@ export const fetchDataLab = dataLabId => dispatch => {
   requestWrapper(parameters);
 };
 
+export const fetchData = ({ dataLabId, query, onFinish }) => dispatch => {
+  // Only the requested page of records is returned (or every record, if a
+  // pageSize of 0 is given), along with the total number of records
+  const parameters = {
+    url: `/datalab/${dataLabId}/data/?${queryString.stringify(query)}`,
+    method: "GET",
+    errorFn: error => {
+      console.log(error);
+    },
+    successFn: response => onFinish(response)
+  };
+
+  requestWrapper(parameters);
+};
+
 export const fetchDatasources = containerId => dispatch => {
   dispatch({ type: START_FETCHING });
 
@@ -612,12 +627,31 @@ export const updateFieldType = (dataLabId, payload) => (dispatch, getState) => {
   requestWrapper(parameters);
 };
 
-export const openVisualisationModal = (visualise, isRowWise, record) => ({
-  type: OPEN_VISUALISATION_MODAL,
-  visualise,
-  isRowWise,
-  record
-});
+export const openVisualisationModal = (visualise, isRowWise, record) => (
+  dispatch,
+  getState
+) => {
+  const { dataLab } = getState();
+
+  dispatch({
+    type: OPEN_VISUALISATION_MODAL,
+    visualise,
+    isRowWise,
+    record
+  });
+
+  // Visualisations are drawn from all of the records, rather than the page of
+  // records shown in the data table
+  dispatch({ type: REFRESH_DATA, data: null });
+  dispatch(
+    fetchData({
+      dataLabId: dataLab.selectedId,
+      query: { pageSize: 0 },
+      onFinish: response =>
+        dispatch({ type: REFRESH_DATA, data: response.records })
+    })
+  );
+};
 
 export const closeVisualisationModal = () => ({
   type: CLOSE_VISUALISATION_MODAL
@@ -28,7 +28,6 @@ function dataLab(state = {}, action) {
       return Object.assign({}, state, {
         selectedId: action.selectedId,
         build: action.build,
-        data: action.data,
         datasources: action.datasources,
         actions: action.actions
       });
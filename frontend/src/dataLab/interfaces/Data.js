@@ -12,6 +12,7 @@ import {
   Input
 } from "antd";
 import moment from "moment";
+import _ from "lodash";
 
 import * as DataLabActionCreators from "../DataLabActions";
 
@@ -36,28 +37,68 @@ class Data extends React.Component {
       editable: {},
       edit: { field: null, primary: null },
       saved: {},
-      searchTerm: ""
+      searchTerm: "",
+      filter: {},
+      page: 1,
+      pageSize: 10,
+      records: [],
+      total: 0,
+      unfilteredTotal: 0,
+      loading: false
     };
+
+    this.debouncedFetchData = _.debounce(this.fetchData, 300);
   }
 
-  initialiseData = () => {
-    const { data, build } = this.props;
-    const { searchTerm } = this.state;
+  componentDidMount() {
+    this.fetchData();
+  }
 
-    if (!data || !build) return [];
+  componentDidUpdate(prevProps) {
+    const { build, selectedId } = this.props;
 
-    const term = searchTerm.trim().toLowerCase();
+    // The build is replaced whenever the DataLab is saved (including when form
+    // values are entered), in which case the current page is fetched again
+    if (build !== prevProps.build || selectedId !== prevProps.selectedId)
+      this.fetchData();
+  }
 
-    const tableData =
-      term === ""
-        ? data
-        : data.filter(row =>
-            String(Object.values(row))
-              .toLowerCase()
-              .includes(term)
-          );
+  componentWillUnmount() {
+    this.debouncedFetchData.cancel();
+  }
 
-    return tableData;
+  fetchData = () => {
+    const { selectedId } = this.props;
+    const { page, pageSize, sort, filter, searchTerm } = this.state;
+
+    if (!selectedId) return;
+
+    // Only the response to the latest request is shown in the table
+    const request = (this.request = (this.request || 0) + 1);
+
+    this.setState({ loading: true });
+    this.boundActionCreators.fetchData({
+      dataLabId: selectedId,
+      query: {
+        page,
+        pageSize,
+        sortField: sort.order ? sort.field : undefined,
+        sortOrder: sort.order,
+        filters: JSON.stringify(filter),
+        search: searchTerm.trim()
+      },
+      onFinish: response => {
+        if (request !== this.request) return;
+
+        this.setState({
+          loading: false,
+          records: response.records,
+          total: response.total,
+          unfilteredTotal: response.unfilteredTotal,
+          page: response.page
+        });
+      }
+    });
   };
 
   initialiseColumns = () => {
@@ -157,7 +198,7 @@ class Data extends React.Component {
 
   DatasourceColumns = stepIndex => {
     const { build } = this.props;
-    // const { sort } = this.state;
+    const { sort } = this.state;
 
     const step = build.steps[stepIndex]["datasource"];
     const columns = [];
@@ -196,12 +237,8 @@ class Data extends React.Component {
         field,
         dataIndex: label,
         key: label,
-        // sorter: (a, b) => {
-        //   a = label in a && a[label];
-        //   b = label in b && b[label];
-        //   return a.localeCompare(b);
-        // },
-        // sortOrder: sort && sort.field === label && sort.order,
+        sorter: true,
+        sortOrder: sort.field === label && sort.order,
         title,
         render: text => text
       });
@@ -212,8 +249,7 @@ class Data extends React.Component {
 
   FormColumns = stepIndex => {
     const { build } = this.props;
-    // const { sort, edit } = this.state;
-    const { edit } = this.state;
+    const { sort, edit } = this.state;
 
     const step = build.steps[stepIndex]["form"];
     const columns = [];
@@ -284,14 +320,8 @@ class Data extends React.Component {
         title,
         dataIndex: label,
         key: label,
-        // sorter: (a, b) => {
-        //   a = label in a ? a[label] : "";
-        //   b = label in b ? b[label] : "";
-        //   if (typeof a === "number" && typeof b === "number")
-        //     return a < b
-        //   return a.toString().localeCompare(b.toString());
-        // },
-        // sortOrder: sort && sort.field === label && sort.order,
+        sorter: true,
+        sortOrder: sort.field === label && sort.order,
         render: (text, record) =>
           this.renderFormField(stepIndex, field, text, record[step.primary])
       });
@@ -302,7 +332,7 @@ class Data extends React.Component {
 
   ComputedColumns = stepIndex => {
     const { build } = this.props;
-    // const { sort } = this.state;
+    const { sort } = this.state;
 
     const step = build.steps[stepIndex]["computed"];
     const columns = [];
@@ -336,14 +366,8 @@ class Data extends React.Component {
         title,
         dataIndex: label,
         key: label,
-        // sorter: (a, b) => {
-        //   a = label in a ? a[label] : "";
-        //   b = label in b ? b[label] : "";
-        //   if (typeof a === "number" && typeof b === "number")
-        //     return a < b
-        //   return a.toString().localeCompare(b.toString());
-        // },
-        // sortOrder: sort && sort.field === label && sort.order,
+        sorter: true,
+        sortOrder: sort.field === label && sort.order,
         render: text => {
           if (Array.isArray(text)) return text.join(", ");
           return text;
@@ -392,20 +416,34 @@ class Data extends React.Component {
   };
 
   handleChange = (pagination, filter, sort) => {
-    this.setState({ filter, sort });
+    this.setState(
+      {
+        page: pagination.current,
+        pageSize: pagination.pageSize,
+        filter,
+        sort
+      },
+      this.fetchData
+    );
   };
 
-  render() {
-    const { visualisation, edit, saved, searchTerm } = this.state;
-    const { data } = this.props;
-
-    const totalDataAmount = data ? data.length : 0;
-
-    // Similarly, the table data is initialised on every render, so that
-    // changes to values in form columns can be reflected
-    const tableData = this.initialiseData();
+  handleSearch = searchTerm => {
+    this.setState({ searchTerm, page: 1 }, this.debouncedFetchData);
+  };
 
-    const tableDataAmount = tableData.length;
+  render() {
+    const {
+      visualisation,
+      edit,
+      saved,
+      searchTerm,
+      records,
+      total,
+      unfilteredTotal,
+      page,
+      pageSize,
+      loading
+    } = this.state;
 
     // Columns are initialised on every render, so that changes to the sort
     // in local state can be reflected in the table columns. Otherwise the
@@ -417,15 +455,15 @@ class Data extends React.Component {
       <div className="data">
         <div className="filter">
           <div>
-            {tableDataAmount} records selected out of {totalDataAmount} (
-            {totalDataAmount - tableDataAmount} filtered out)
+            {total} records selected out of {unfilteredTotal} (
+            {unfilteredTotal - total} filtered out)
           </div>
           <Search
             className="searchbar"
             size="large"
             placeholder="Search..."
             value={searchTerm}
-            onChange={e => this.setState({ searchTerm: e.target.value })}
+            onChange={e => this.handleSearch(e.target.value)}
           />
         </div>
         <div className="data_manipulation">
@@ -439,10 +477,14 @@ class Data extends React.Component {
           <Table
             rowKey={(record, index) => index}
             columns={orderedColumns}
-            dataSource={orderedColumns.length > 0 ? tableData : []}
+            dataSource={orderedColumns.length > 0 ? records : []}
+            loading={loading}
             scroll={{ x: (orderedColumns.length - 1) * 175 }}
             onChange={this.handleChange}
             pagination={{
+              current: page,
+              pageSize,
+              total,
               showSizeChanger: true,
               pageSizeOptions: ["10", "25", "50", "100"]
             }}
@@ -459,11 +501,10 @@ class Data extends React.Component {
 }
 
 const mapStateToProps = state => {
-  const { build, data, selectedId } = state.dataLab;
+  const { build, selectedId } = state.dataLab;
 
   return {
     build,
-    data,
     selectedId
   };
 };